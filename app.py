@@ -2,14 +2,43 @@
 import os
 import io
 import csv
+import json
+import math
+import base64
 import sqlite3
 import re
+import hashlib
+import mimetypes
+import unicodedata
+import zipfile
+import zlib
+from xml.sax.saxutils import escape as xml_escape
+import gzip
+import shutil
+import tempfile
+import time
+import queue
+import threading
 from datetime import datetime
 from functools import wraps
+from concurrent.futures import ThreadPoolExecutor
+
+import click
+
+try:
+    import fcntl
+except ImportError:  # no flock (Windows): limits fall back to per-process only
+    fcntl = None
+
+try:
+    import brotli
+except ImportError:  # optional: without it responses are gzip-only
+    brotli = None
 
 from flask import (
-    Flask, render_template, request, redirect, url_for, flash, session, send_file
+    Flask, render_template, request, redirect, url_for, flash, session, send_file, Response, jsonify, g
 )
+from werkzeug.wsgi import ClosingIterator
 from werkzeug.security import generate_password_hash, check_password_hash
 from reportlab.pdfgen import canvas
 from reportlab.lib.pagesizes import letter
@@ -18,23 +47,221 @@ from reportlab.lib.pagesizes import letter
 # Config
 # -------------------------
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
-DB_PATH = os.path.join(BASE_DIR, "database.db")
+DB_PATH = os.environ.get("DB_PATH", os.path.join(BASE_DIR, "database.db"))
 
 app = Flask(__name__, static_folder="static", template_folder="templates")
 app.secret_key = os.environ.get("FLASK_SECRET", "troque_para_uma_chave_secreta")
 
+# group-commit writer (opt-in): WRITE_QUEUE=1 sends form writes through a single
+# writer thread per worker that commits them in batches. Batches only form when
+# a worker serves several requests at once, i.e. with threaded workers
+# (gunicorn -k gthread --threads N); under the default sync workers each batch
+# holds one job and the queue only adds a thread hop. Writers in different
+# workers still contend for the database lock; the writer waits up to
+# WRITE_QUEUE_BUSY_TIMEOUT_MS for it instead of failing with "database is locked".
+WRITE_QUEUE_ENABLED = os.environ.get("WRITE_QUEUE", "0").lower() in ("1", "true", "on")
+WRITE_QUEUE_BATCH = int(os.environ.get("WRITE_QUEUE_BATCH", "64"))
+WRITE_QUEUE_WAIT_MS = float(os.environ.get("WRITE_QUEUE_WAIT_MS", "0"))
+WRITE_QUEUE_BUSY_TIMEOUT_MS = int(os.environ.get("WRITE_QUEUE_BUSY_TIMEOUT_MS", "30000"))
+
+# online backups: compressed snapshots copied a few pages at a time
+BACKUP_DIR = os.environ.get("BACKUP_DIR", os.path.join(BASE_DIR, "backups"))
+BACKUP_KEEP = int(os.environ.get("BACKUP_KEEP", "7"))
+BACKUP_PAGES = int(os.environ.get("BACKUP_PAGES", "256"))
+BACKUP_SLEEP_MS = float(os.environ.get("BACKUP_SLEEP_MS", "50"))
+BACKUP_MAX_RESTARTS = int(os.environ.get("BACKUP_MAX_RESTARTS", "5"))
+
+# generated exports shared by all workers on disk, LRU-bounded (0 disables)
+EXPORT_CACHE_DIR = os.environ.get("EXPORT_CACHE_DIR", os.path.join(BASE_DIR, "export_cache"))
+EXPORT_CACHE_MAX_BYTES = int(os.environ.get("EXPORT_CACHE_MAX_MB", "512")) * 1024 * 1024
+
+# admission control: concurrent heavy requests allowed per endpoint class across
+# all workers (0 = unlimited). Keep these below the gunicorn worker count so
+# /table and /submit always find a free worker.
+CONCURRENCY_LIMITS = {
+    "exports": int(os.environ.get("LIMIT_EXPORTS", "2")),
+    "bulk": int(os.environ.get("LIMIT_BULK", "2")),
+    "login": int(os.environ.get("LIMIT_LOGIN", "4")),
+    "backup": 1,  # one snapshot at a time, whether from the web page or the CLI
+}
+LIMIT_RETRY_AFTER = int(os.environ.get("LIMIT_RETRY_AFTER", "5"))
+# slot files; private to the app's user (see _limit_dir_usable)
+LIMIT_DIR = os.environ.get("LIMIT_DIR", os.path.join(os.path.dirname(DB_PATH), "limits"))
+
+# response compression: HTML/CSV/JSON bodies at least this big get gzip (or br)
+COMPRESS_MIN_SIZE = int(os.environ.get("COMPRESS_MIN_SIZE", "1024"))
+COMPRESS_LEVEL = int(os.environ.get("COMPRESS_LEVEL", "6"))
+
+# password hashing: werkzeug method string, e.g. "scrypt:16384:8:1" or
+# "pbkdf2:sha256:600000" (use `flask bench-login` to pick one). Stored hashes
+# with other parameters are upgraded on the user's next login.
+PASSWORD_HASH_METHOD = os.environ.get("PASSWORD_HASH_METHOD", "scrypt:32768:8:1")
+# threads verifying login passwords; hashlib releases the GIL while hashing
+LOGIN_HASH_WORKERS = int(os.environ.get("LOGIN_HASH_WORKERS", "2"))
+
+# -------------------------
+# Password hashing
+# -------------------------
+_hash_prefixes = {}
+_hash_pool = None
+_hash_pool_lock = threading.Lock()
+
+def hash_password(password, method=None):
+    return generate_password_hash(password, method=method or PASSWORD_HASH_METHOD)
+
+def on_hash_pool(fn, *args):
+    """Run a hashing call on the bounded hashing pool and wait for it, so a
+    burst of logins queues there instead of each request thread hashing at once."""
+    global _hash_pool
+    with _hash_pool_lock:
+        if _hash_pool is None:
+            _hash_pool = ThreadPoolExecutor(max_workers=max(1, LOGIN_HASH_WORKERS), thread_name_prefix="pwhash")
+    return _hash_pool.submit(fn, *args).result()
+
+def hash_prefix(method=None):
+    """Parameter part ("scrypt:32768:8:1") of hashes made with method, as stored."""
+    method = method or PASSWORD_HASH_METHOD
+    if method not in _hash_prefixes:
+        _hash_prefixes[method] = on_hash_pool(hash_password, "", method).split("$", 1)[0]
+    return _hash_prefixes[method]
+
+def password_needs_rehash(pw_hash):
+    return (pw_hash or "").split("$", 1)[0] != hash_prefix()
+
+def verify_password(pw_hash, password):
+    return on_hash_pool(check_password_hash, pw_hash, password)
+
 # -------------------------
 # DB helpers
 # -------------------------
+# columns exported / streamed for a registro, in table order
+REGISTRO_COLUMNS = ["id","nome","cpf","escritorio_chave","escritorio_nome","tipo_acao","data_fechamento","pendencias","numero_processo","data_protocolo","observacoes","captador","created_at"]
+REGISTRO_COLUMNS_SQL = ", ".join(REGISTRO_COLUMNS)
+
+# /table ?sort= whitelist -> column; each has (escritorio_chave, column) and
+# (column) indexes, which end in the rowid and so are ordered by (column, id)
+TABLE_SORTS = {
+    "id": "id",
+    "data_fechamento": "data_fechamento",
+    "data_protocolo": "data_protocolo",
+    "nome": "nome_norm",
+    "captador": "captador",
+}
+
 def get_conn():
     conn = sqlite3.connect(DB_PATH)
     # we will keep row access by index in many templates, so default row factory is fine
     return conn
 
+def fold_name(name):
+    """Lowercase, accent-free, single-spaced form of a name (search/identity key)."""
+    if not name:
+        return ""
+    s = unicodedata.normalize("NFKD", name)
+    s = "".join(ch for ch in s if not unicodedata.combining(ch))
+    return " ".join(s.lower().split())
+
+def cpf_digits(cpf):
+    return re.sub(r"\D", "", cpf or "")
+
+def _ensure_column(c, table, column, decl):
+    c.execute(f"PRAGMA table_info({table})")
+    if column not in [r[1] for r in c.fetchall()]:
+        c.execute(f"ALTER TABLE {table} ADD COLUMN {column} {decl}")
+
+_NOW_SQL = "strftime('%Y-%m-%dT%H:%M:%f','now')"
+
+CHANGE_LOG_TRIGGERS = [
+    f"""
+    CREATE TRIGGER IF NOT EXISTS registros_change_insert AFTER INSERT ON registros BEGIN
+        INSERT INTO change_log (table_name, row_id, op, escritorio_chave, escritorio_origem, changed_at)
+        VALUES ('registros', NEW.id,
+                CASE WHEN EXISTS (SELECT 1 FROM excluidos WHERE created_at = NEW.created_at AND cpf IS NEW.cpf AND nome IS NEW.nome)
+                     THEN 'restore' ELSE 'insert' END,
+                NEW.escritorio_chave, NULL, {_NOW_SQL});
+    END
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS registros_change_update AFTER UPDATE OF
+        nome, cpf, escritorio_chave, escritorio_nome, tipo_acao, data_fechamento, pendencias,
+        numero_processo, data_protocolo, observacoes, captador, created_at, updated_at
+    ON registros BEGIN
+        INSERT INTO change_log (table_name, row_id, op, escritorio_chave, escritorio_origem, changed_at)
+        VALUES ('registros', NEW.id,
+                CASE WHEN OLD.escritorio_chave IS NOT NEW.escritorio_chave THEN 'migrate' ELSE 'update' END,
+                NEW.escritorio_chave, OLD.escritorio_chave, {_NOW_SQL});
+    END
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS registros_change_delete AFTER DELETE ON registros BEGIN
+        INSERT INTO change_log (table_name, row_id, op, escritorio_chave, escritorio_origem, changed_at)
+        VALUES ('registros', OLD.id, 'delete', OLD.escritorio_chave, NULL, {_NOW_SQL});
+    END
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS excluidos_change_insert AFTER INSERT ON excluidos BEGIN
+        INSERT INTO change_log (table_name, row_id, op, escritorio_chave, escritorio_origem, changed_at)
+        VALUES ('excluidos', NEW.id, 'insert', NEW.escritorio_origem_chave, NULL, {_NOW_SQL});
+    END
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS excluidos_change_update AFTER UPDATE OF
+        nome, cpf, escritorio_origem, escritorio_origem_chave, tipo_acao, data_fechamento, pendencias,
+        numero_processo, data_protocolo, observacoes, captador, created_at, data_exclusao, updated_at
+    ON excluidos BEGIN
+        INSERT INTO change_log (table_name, row_id, op, escritorio_chave, escritorio_origem, changed_at)
+        VALUES ('excluidos', NEW.id, 'update', NEW.escritorio_origem_chave, OLD.escritorio_origem_chave, {_NOW_SQL});
+    END
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS excluidos_change_delete AFTER DELETE ON excluidos BEGIN
+        INSERT INTO change_log (table_name, row_id, op, escritorio_chave, escritorio_origem, changed_at)
+        VALUES ('excluidos', OLD.id,
+                CASE WHEN EXISTS (SELECT 1 FROM registros WHERE created_at = OLD.created_at AND cpf IS OLD.cpf AND nome IS OLD.nome)
+                     THEN 'restore' ELSE 'delete' END,
+                OLD.escritorio_origem_chave, NULL, {_NOW_SQL});
+    END
+    """,
+]
+
+def _identity_key_sql(prefix):
+    # prefix is "NEW." inside triggers, "" in plain SELECTs; NULL when there is
+    # neither a CPF nor a name to go by
+    return (f"CASE WHEN COALESCE({prefix}cpf_norm, '') <> '' THEN 'cpf:' || {prefix}cpf_norm "
+            f"WHEN COALESCE({prefix}nome_norm, '') <> '' THEN 'nome:' || {prefix}nome_norm END")
+
+def _identity_triggers():
+    out = []
+    for table_name, office_col in (("registros", "escritorio_chave"), ("excluidos", "escritorio_origem_chave")):
+        upsert = f"""
+            INSERT OR REPLACE INTO identidades (source, row_id, identity_key, nome_norm, escritorio_chave)
+            VALUES ('{table_name}', NEW.id, {_identity_key_sql("NEW.")}, NEW.nome_norm, NEW.{office_col});
+        """
+        out += [
+            f"CREATE TRIGGER IF NOT EXISTS {table_name}_identity_insert AFTER INSERT ON {table_name} BEGIN {upsert} END",
+            f"CREATE TRIGGER IF NOT EXISTS {table_name}_identity_update AFTER UPDATE OF nome_norm, cpf_norm, {office_col} "
+            f"ON {table_name} BEGIN {upsert} END",
+            f"CREATE TRIGGER IF NOT EXISTS {table_name}_identity_delete AFTER DELETE ON {table_name} BEGIN "
+            f"DELETE FROM identidades WHERE source = '{table_name}' AND row_id = OLD.id; END",
+        ]
+    return out
+
+IDENTITY_TRIGGERS = _identity_triggers()
+
+def identity_key(nome, cpf):
+    digits = cpf_digits(cpf)
+    if digits:
+        return f"cpf:{digits}"
+    name = fold_name(nome)
+    return f"nome:{name}" if name else None
+
 def init_db():
     conn = get_conn()
     c = conn.cursor()
 
+    # WAL lets readers keep going while the (single) writer commits
+    c.execute("PRAGMA journal_mode=WAL")
+
     # main records table (single table with escritório field)
     c.execute("""
         CREATE TABLE IF NOT EXISTS registros (
@@ -101,6 +328,89 @@ def init_db():
             PRIMARY KEY(user_id, office_key)
         )
     """)
+    # bumped whenever a user's office assignments change; invalidates the
+    # office list cached in that user's session
+    _ensure_column(c, "users", "acl_version", "INTEGER DEFAULT 0")
+
+    # columns added after the first release
+    _ensure_column(c, "registros", "updated_at", "TEXT")
+    _ensure_column(c, "excluidos", "updated_at", "TEXT")
+    c.execute("UPDATE registros SET updated_at = created_at WHERE updated_at IS NULL")
+    c.execute("UPDATE excluidos SET updated_at = COALESCE(data_exclusao, created_at) WHERE updated_at IS NULL")
+
+    # append-only change log for downstream sync (see /changes)
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS change_log (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            table_name TEXT,
+            row_id INTEGER,
+            op TEXT,
+            escritorio_chave TEXT,
+            escritorio_origem TEXT,
+            changed_at TEXT
+        )
+    """)
+    # restore copies created_at/cpf/nome, which is how the triggers tell a
+    # restore (registros insert + excluidos delete) apart from a plain insert/purge
+    c.execute("CREATE INDEX IF NOT EXISTS idx_registros_created_at ON registros(created_at)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_excluidos_created_at ON excluidos(created_at)")
+    for sql in CHANGE_LOG_TRIGGERS:
+        c.execute(sql)
+    # latest change per office = data version of cached exports
+    c.execute("CREATE INDEX IF NOT EXISTS idx_change_log_office ON change_log(escritorio_chave, seq)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_change_log_origem ON change_log(escritorio_origem, seq)")
+
+    # normalized search keys (accent-folded name, digits-only CPF) for typeahead
+    _ensure_column(c, "registros", "nome_norm", "TEXT")
+    _ensure_column(c, "registros", "cpf_norm", "TEXT")
+    c.execute("SELECT id, nome, cpf FROM registros WHERE nome_norm IS NULL OR cpf_norm IS NULL")
+    c.executemany("UPDATE registros SET nome_norm=?, cpf_norm=? WHERE id=?",
+                  [(fold_name(r[1]), cpf_digits(r[2]), r[0]) for r in c.fetchall()])
+    c.execute("CREATE INDEX IF NOT EXISTS idx_registros_office_nome_norm ON registros(escritorio_chave, nome_norm)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_registros_office_cpf_norm ON registros(escritorio_chave, cpf_norm)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_registros_nome_norm ON registros(nome_norm)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_registros_cpf_norm ON registros(cpf_norm)")
+    # sorted /table pages are a covering walk of one of these, per office or (ALL)
+    # overall; nome sorts on the nome_norm indexes above, id overall on the rowid
+    c.execute("CREATE INDEX IF NOT EXISTS idx_registros_office_id ON registros(escritorio_chave, id)")
+    for col in ("data_fechamento", "data_protocolo", "captador"):
+        c.execute(f"CREATE INDEX IF NOT EXISTS idx_registros_office_{col} ON registros(escritorio_chave, {col})")
+        c.execute(f"CREATE INDEX IF NOT EXISTS idx_registros_{col} ON registros({col})")
+    _ensure_column(c, "excluidos", "nome_norm", "TEXT")
+    _ensure_column(c, "excluidos", "cpf_norm", "TEXT")
+    c.execute("SELECT id, nome, cpf FROM excluidos WHERE nome_norm IS NULL OR cpf_norm IS NULL")
+    c.executemany("UPDATE excluidos SET nome_norm=?, cpf_norm=? WHERE id=?",
+                  [(fold_name(r[1]), cpf_digits(r[2]), r[0]) for r in c.fetchall()])
+
+    # client identity index across registros + excluidos (duplicate detection);
+    # identity_key is the CPF digits, or the folded name when there is no CPF
+    c.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='identidades'")
+    fill_identities = c.fetchone() is None
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS identidades (
+            source TEXT,
+            row_id INTEGER,
+            identity_key TEXT,
+            nome_norm TEXT,
+            escritorio_chave TEXT,
+            PRIMARY KEY(source, row_id)
+        ) WITHOUT ROWID
+    """)
+    # blank clients (no CPF, no name) have a NULL identity and stay out of the index
+    c.execute("CREATE INDEX IF NOT EXISTS idx_identidades_key ON identidades(identity_key, source, row_id) "
+              "WHERE identity_key IS NOT NULL")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_identidades_nome ON identidades(nome_norm)")
+    for sql in IDENTITY_TRIGGERS:
+        c.execute(sql)
+    if fill_identities:
+        c.execute(f"""
+            INSERT OR REPLACE INTO identidades (source, row_id, identity_key, nome_norm, escritorio_chave)
+            SELECT 'registros', id, {_identity_key_sql("")}, nome_norm, escritorio_chave FROM registros
+        """)
+        c.execute(f"""
+            INSERT OR REPLACE INTO identidades (source, row_id, identity_key, nome_norm, escritorio_chave)
+            SELECT 'excluidos', id, {_identity_key_sql("")}, nome_norm, escritorio_origem_chave FROM excluidos
+        """)
 
     conn.commit()
 
@@ -112,7 +422,7 @@ def init_db():
     c.execute("SELECT COUNT(*) FROM users")
     if c.fetchone()[0] == 0:
         now = datetime.utcnow().isoformat()
-        pw_hash = generate_password_hash("admin")
+        pw_hash = hash_password("admin")
         c.execute("INSERT INTO users (username, full_name, password_hash, role, active, created_at) VALUES (?,?,?,?,?,?)",
                   ("admin", "Administrador Padrão", pw_hash, "ADMIN", 1, now))
         conn.commit()
@@ -122,6 +432,133 @@ def init_db():
 # initialize
 init_db()
 
+# -------------------------
+# Write queue (group commit)
+# -------------------------
+class _WriteJob:
+    __slots__ = ("fn", "args", "done", "result", "error")
+
+    def __init__(self, fn, args):
+        self.fn = fn
+        self.args = args
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+class WriteQueue:
+    """Single writer thread that group-commits queued write jobs.
+
+    A job is a callable receiving a cursor. Jobs collected in the same batch run
+    in one transaction, each under its own SAVEPOINT so a failing job does not
+    take the others down, and the caller blocks until the COMMIT has returned.
+    """
+
+    def __init__(self, batch_size=64, max_wait=0.0):
+        self.batch_size = max(1, batch_size)
+        self.max_wait = max(0.0, max_wait)
+        self._lock = threading.Lock()
+        self._queue = None
+        self._thread = None
+        self._pid = None
+
+    def _ensure_thread(self):
+        # started lazily so every gunicorn worker gets its own writer after fork
+        with self._lock:
+            if self._pid != os.getpid():
+                self._queue = queue.Queue()
+                self._thread = None
+                self._pid = os.getpid()
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="write-queue", daemon=True)
+                self._thread.start()
+            return self._queue
+
+    def submit(self, fn, *args):
+        q = self._ensure_thread()
+        job = _WriteJob(fn, args)
+        q.put(job)
+        while not job.done.wait(1.0):
+            # writer died (see _run): start another one, it picks the job up
+            self._ensure_thread()
+        if job.error is not None:
+            raise job.error
+        return job.result
+
+    def _run(self):
+        q = self._queue
+        try:
+            conn = get_conn()
+            conn.isolation_level = None  # we issue BEGIN/COMMIT ourselves
+            # BEGIN IMMEDIATE waits for other workers' writers rather than raising
+            conn.execute(f"PRAGMA busy_timeout = {WRITE_QUEUE_BUSY_TIMEOUT_MS}")
+            c = conn.cursor()
+        except Exception as e:
+            # no connection: fail whatever is queued instead of leaving callers blocked
+            while True:
+                try:
+                    job = q.get_nowait()
+                except queue.Empty:
+                    return
+                job.error = e
+                job.done.set()
+        while True:
+            batch = [q.get()]
+            # whatever queued up while the previous batch was committing joins this one
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.batch_size:
+                timeout = deadline - time.monotonic()
+                try:
+                    batch.append(q.get(timeout=timeout) if timeout > 0 else q.get_nowait())
+                except queue.Empty:
+                    break
+            self._commit_batch(conn, c, batch)
+
+    def _commit_batch(self, conn, c, batch):
+        try:
+            c.execute("BEGIN IMMEDIATE")
+            for job in batch:
+                c.execute("SAVEPOINT job")
+                try:
+                    job.result = job.fn(c, *job.args)
+                    c.execute("RELEASE job")
+                except Exception as e:
+                    c.execute("ROLLBACK TO job")
+                    c.execute("RELEASE job")
+                    job.error = e
+            c.execute("COMMIT")
+        except Exception as e:
+            if conn.in_transaction:
+                c.execute("ROLLBACK")
+            for job in batch:
+                if job.error is None:
+                    job.result = None
+                    job.error = e
+        finally:
+            for job in batch:
+                job.done.set()
+
+write_queue = WriteQueue(WRITE_QUEUE_BATCH, WRITE_QUEUE_WAIT_MS / 1000.0) if WRITE_QUEUE_ENABLED else None
+
+def run_write(fn, *args):
+    """Run fn(cursor, *args) in a write transaction and return its result.
+
+    With WRITE_QUEUE enabled the job goes through the group-commit writer,
+    otherwise it gets its own connection and commit. Either way this only
+    returns once the data is committed.
+    """
+    if write_queue is not None:
+        return write_queue.submit(fn, *args)
+    conn = get_conn()
+    try:
+        result = fn(conn.cursor(), *args)
+        conn.commit()
+        return result
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
 # -------------------------
 # Utilities
 # -------------------------
@@ -133,12 +570,16 @@ def normalize_office_key(name: str) -> str:
     s = re.sub(r'[^A-Z0-9_]', '', s)
     return s or "CENTRAL"
 
-def register_office(office_key: str, display_name: str = None):
+def register_office(office_key: str, display_name: str = None, c=None):
     if not office_key:
         office_key = "CENTRAL"
     if not display_name:
         display_name = office_key.replace("_", " ")
     display_name = display_name.upper()
+    if c is not None:
+        # caller's transaction (e.g. a write-queue job) commits it
+        c.execute("INSERT OR IGNORE INTO offices (office_key, display_name) VALUES (?,?)", (office_key, display_name))
+        return
     conn = get_conn()
     c = conn.cursor()
     c.execute("INSERT OR IGNORE INTO offices (office_key, display_name) VALUES (?,?)", (office_key, display_name))
@@ -188,12 +629,12 @@ def get_user_by_username(username):
 def get_user_by_id(uid):
     conn = get_conn()
     c = conn.cursor()
-    c.execute("SELECT id, username, full_name, role, active FROM users WHERE id=?", (uid,))
+    c.execute("SELECT id, username, full_name, role, active, acl_version FROM users WHERE id=?", (uid,))
     row = c.fetchone()
     conn.close()
     if not row:
         return None
-    return {"id": row[0], "username": row[1], "full_name": row[2], "role": row[3], "active": row[4]}
+    return {"id": row[0], "username": row[1], "full_name": row[2], "role": row[3], "active": row[4], "acl_version": row[5] or 0}
 
 def get_user_offices(user_id):
     conn = get_conn()
@@ -203,12 +644,68 @@ def get_user_offices(user_id):
     conn.close()
     return [r[0] for r in rows]
 
+def load_current_user():
+    """The logged-in user's row, fetched at most once per request."""
+    if "user_id" not in session:
+        return None
+    if "current_user" not in g:
+        g.current_user = get_user_by_id(session["user_id"])
+    return g.current_user
+
+# roles that see every office; everyone else is limited to user_offices
+UNRESTRICTED_ROLES = ("ADMIN", "SUPERVISOR")
+
+def allowed_offices():
+    """Office keys the current user may access, or None when unrestricted.
+
+    The list is cached in the session, tagged with users.acl_version. That
+    column comes along with the user row every request already loads, so an
+    unchanged ACL costs no query and a change made in admin_users_offices is
+    picked up on the user's next request.
+    """
+    if "allowed_offices" in g:
+        return g.allowed_offices
+    user = load_current_user()
+    if user is None:
+        acl = []
+    elif user["role"] in UNRESTRICTED_ROLES:
+        acl = None
+    else:
+        cached = session.get("acl")
+        if cached and cached.get("uid") == user["id"] and cached.get("v") == user["acl_version"]:
+            acl = cached["offices"]
+        else:
+            acl = sorted(normalize_office_key(k) for k in get_user_offices(user["id"]))
+            session["acl"] = {"uid": user["id"], "v": user["acl_version"], "offices": acl}
+    g.allowed_offices = acl
+    return acl
+
+def can_access_office(office_key):
+    acl = allowed_offices()
+    return acl is None or normalize_office_key(office_key) in acl
+
+def office_scope_sql(column="escritorio_chave"):
+    """(sql, params) restricting `column` to the user's offices, for any WHERE."""
+    acl = allowed_offices()
+    if acl is None:
+        return "1=1", []
+    if not acl:
+        return "1=0", []
+    return f"{column} IN ({','.join('?' * len(acl))})", [f"office_{k}" for k in acl]
+
+def visible_offices():
+    acl = allowed_offices()
+    offices = list_offices()
+    if acl is None:
+        return offices
+    return [o for o in offices if o["key"] in acl]
+
 def login_required(f):
     @wraps(f)
     def decorated(*args, **kwargs):
         if "user_id" not in session:
             return redirect(url_for("login", next=request.path))
-        user = get_user_by_id(session["user_id"])
+        user = load_current_user()
         if not user or user["active"] != 1:
             session.pop("user_id", None)
             flash("Sessão inválida. Faça login novamente.", "error")
@@ -223,7 +720,7 @@ def require_roles(*roles):
         def decorated(*args, **kwargs):
             if "user_id" not in session:
                 return redirect(url_for("login"))
-            user = get_user_by_id(session["user_id"])
+            user = load_current_user()
             if not user:
                 session.pop("user_id", None)
                 return redirect(url_for("login"))
@@ -235,18 +732,212 @@ def require_roles(*roles):
         return decorated
     return wrapper
 
+# -------------------------
+# Admission control
+# -------------------------
+_local_slots = {}
+_local_slots_lock = threading.Lock()
+_limit_dir_checked = None
+
+def _limit_dir_usable():
+    """Create LIMIT_DIR (0700) and make sure no other user can touch its slots.
+
+    Anyone who can create or flock our slot files could hold every slot and
+    turn all logins and exports into 429s, so a directory owned by another user
+    or writable by group/others is refused; the limits then only hold per process.
+    """
+    global _limit_dir_checked
+    if _limit_dir_checked is None:
+        try:
+            os.makedirs(LIMIT_DIR, mode=0o700, exist_ok=True)
+            st = os.stat(LIMIT_DIR)
+            _limit_dir_checked = st.st_uid == os.getuid() and not st.st_mode & 0o022
+        except OSError:
+            _limit_dir_checked = False
+        if not _limit_dir_checked:
+            app.logger.error("LIMIT_DIR %s não é privado deste usuário; limites valem só por processo", LIMIT_DIR)
+    return _limit_dir_checked
+
+def _acquire_slot(cls):
+    """Take one of the class's slots without waiting.
+
+    Returns a release callable, or None if every slot is busy. Slots are
+    flock()ed files, one per slot, so the limit holds across gunicorn workers
+    and a crashed worker gives its slot back automatically.
+    """
+    limit = CONCURRENCY_LIMITS.get(cls, 0)
+    if limit <= 0:
+        return lambda: None
+    if fcntl is None or not _limit_dir_usable():
+        with _local_slots_lock:
+            sem = _local_slots.setdefault(cls, threading.BoundedSemaphore(limit))
+        return sem.release if sem.acquire(blocking=False) else None
+    for i in range(limit):
+        fd = os.open(os.path.join(LIMIT_DIR, f"{cls}.{i}.lock"), os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            os.close(fd)
+            continue
+        released = []
+
+        def release(fd=fd, released=released):
+            if not released:
+                released.append(True)
+                os.close(fd)  # closing the descriptor drops the lock
+        return release
+    return None
+
+def _too_busy():
+    return Response("Servidor ocupado com outras operações pesadas. Tente novamente em alguns segundos.\n",
+                    status=429, mimetype="text/plain", headers={"Retry-After": str(LIMIT_RETRY_AFTER)})
+
+def limit_concurrency(cls, methods=None):
+    """Reject with 429 + Retry-After instead of queueing when `cls` is at its limit.
+
+    Streamed responses (exports) keep the slot until the body has been sent.
+    """
+    def wrapper(f):
+        @wraps(f)
+        def decorated(*args, **kwargs):
+            if methods and request.method not in methods:
+                return f(*args, **kwargs)
+            release = _acquire_slot(cls)
+            if release is None:
+                return _too_busy()
+            try:
+                rv = app.make_response(f(*args, **kwargs))
+            except BaseException:
+                release()
+                raise
+            if rv.direct_passthrough:
+                # send_file responses skip the close hooks in get_app_iter;
+                # release when the server closes the body instead
+                rv.response = ClosingIterator(rv.response, [release])
+            elif rv.is_streamed:
+                rv.call_on_close(release)
+            else:
+                release()
+            return rv
+        return decorated
+    return wrapper
+
 # expose current_user to templates
 @app.context_processor
 def inject_user():
-    user = None
-    if "user_id" in session:
-        user = get_user_by_id(session["user_id"])
-    return {"current_user": user}
+    return {"current_user": load_current_user()}
+
+# -------------------------
+# Static assets & response compression
+# -------------------------
+STATIC_MAX_AGE = 365 * 24 * 3600
+COMPRESSIBLE_MIMETYPES = {
+    "text/html", "text/css", "text/plain", "text/csv", "image/svg+xml",
+    "application/javascript", "text/javascript", "application/json", "application/x-ndjson",
+}
+
+def _build_static_assets():
+    """Content hash and precompressed bodies of every file in static/, built once."""
+    assets = {}
+    for root, _, files in os.walk(app.static_folder):
+        for name in files:
+            path = os.path.join(root, name)
+            rel = os.path.relpath(path, app.static_folder).replace(os.sep, "/")
+            with open(path, "rb") as f:
+                data = f.read()
+            mimetype = mimetypes.guess_type(name)[0] or "application/octet-stream"
+            entry = {"hash": hashlib.sha256(data).hexdigest()[:12], "mimetype": mimetype,
+                     "mtime": os.path.getmtime(path)}
+            if mimetype in COMPRESSIBLE_MIMETYPES:
+                entry["gzip"] = gzip.compress(data, 9, mtime=0)
+                if brotli is not None:
+                    entry["br"] = brotli.compress(data)
+            assets[rel] = entry
+    return assets
+
+STATIC_ASSETS = _build_static_assets()
+
+@app.template_global()
+def asset_url(filename):
+    """url_for('static') plus a content hash, so the URL changes with the file."""
+    entry = STATIC_ASSETS.get(filename)
+    if entry is None:
+        return url_for("static", filename=filename)
+    return url_for("static", filename=filename, v=entry["hash"])
+
+def _accepted_encoding(allow_br=True):
+    accepted = request.accept_encodings
+    if allow_br and brotli is not None and accepted["br"]:
+        return "br"
+    if accepted["gzip"]:
+        return "gzip"
+    return None
+
+def _static_view(filename):
+    entry = STATIC_ASSETS.get(filename)
+    encoding = _accepted_encoding() if entry else None
+    if encoding and encoding in entry:
+        rv = Response(entry[encoding], mimetype=entry["mimetype"])
+        rv.headers["Content-Encoding"] = encoding
+        rv.set_etag(f"{entry['hash']}-{encoding}")
+        rv.last_modified = datetime.utcfromtimestamp(entry["mtime"])
+        rv.make_conditional(request)
+    else:
+        rv = app.send_static_file(filename)
+    rv.vary.add("Accept-Encoding")
+    if entry and request.args.get("v") == entry["hash"]:
+        # fingerprinted URL: contents can never change under it
+        rv.cache_control.public = True
+        rv.cache_control.max_age = STATIC_MAX_AGE
+        rv.cache_control.immutable = True
+    return rv
+
+app.view_functions["static"] = _static_view
+
+def _gzip_stream(chunks):
+    try:
+        # views may stream str (e.g. /changes); Werkzeug would have encoded those as UTF-8
+        yield from _gzip_chunks(c.encode("utf-8") if isinstance(c, str) else c for c in chunks)
+    finally:
+        # closing the inner generator releases its DB connection / cache temp file
+        if hasattr(chunks, "close"):
+            chunks.close()
+
+@app.after_request
+def compress_response(response):
+    if (request.endpoint == "static" or response.direct_passthrough
+            or response.status_code < 200 or response.status_code in (204, 206, 304)
+            or "Content-Encoding" in response.headers
+            or response.mimetype not in COMPRESSIBLE_MIMETYPES):
+        return response
+    response.vary.add("Accept-Encoding")
+    if response.is_streamed:
+        # size unknown up front: always compress, gzip only (incremental)
+        encoding = _accepted_encoding(allow_br=False)
+        if not encoding:
+            return response
+        response.response = _gzip_stream(response.response)
+        response.headers.pop("Content-Length", None)
+    else:
+        encoding = _accepted_encoding()
+        data = response.get_data()
+        if not encoding or len(data) < COMPRESS_MIN_SIZE:
+            return response
+        if encoding == "br":
+            response.set_data(brotli.compress(data, quality=5))
+        else:
+            response.set_data(gzip.compress(data, COMPRESS_LEVEL))
+    response.headers["Content-Encoding"] = encoding
+    etag, weak = response.get_etag()
+    if etag:
+        response.set_etag(f"{etag}-{encoding}", weak)
+    return response
 
 # -------------------------
 # Auth routes
 # -------------------------
 @app.route("/login", methods=["GET", "POST"])
+@limit_concurrency("login", methods=("POST",))
 def login():
     next_page = request.args.get("next") or url_for("index")
     if request.method == "POST":
@@ -256,7 +947,15 @@ def login():
         if not u or not u["active"]:
             flash("Usuário inválido ou inativo.", "error")
             return render_template("login.html")
-        if check_password_hash(u["password_hash"], password):
+        if verify_password(u["password_hash"], password):
+            if password_needs_rehash(u["password_hash"]):
+                # stored with older parameters: upgrade while we have the plaintext
+                conn = get_conn()
+                conn.execute("UPDATE users SET password_hash=? WHERE id=? AND password_hash=?",
+                             (on_hash_pool(hash_password, password), u["id"], u["password_hash"]))
+                conn.commit()
+                conn.close()
+            session.pop("acl", None)
             session["user_id"] = u["id"]
             flash("Login efetuado.", "success")
             return redirect(next_page)
@@ -268,18 +967,119 @@ def login():
 @app.route("/logout")
 def logout():
     session.pop("user_id", None)
+    session.pop("acl", None)
     flash("Desconectado.", "info")
     return redirect(url_for("login"))
 
+# -------------------------
+# Duplicate detection
+# -------------------------
+DUPLICATE_WARN_LIMIT = 5
+DUPLICADOS_PER_PAGE = 50
+
+def find_duplicates(c, nome, cpf, exclude_id=None):
+    """Registros/excluidos that may be the same client: same CPF, or same folded
+    name where at least one of the two has no CPF (two different CPFs are two
+    different people).
+
+    Two index probes on identidades, whatever the table sizes.
+    """
+    key = identity_key(nome, cpf)
+    if key is None:
+        return []
+    name_key = fold_name(nome)
+    if key.startswith("cpf:"):
+        # same CPF, or a CPF-less client with the same name
+        where, params = "identity_key IN (?, ?)", [key, f"nome:{name_key}"]
+    else:
+        # no CPF here: anyone with the same name
+        where, params = "nome_norm = ?", [name_key]
+    c.execute(f"""
+        SELECT source, row_id, escritorio_chave FROM identidades
+        WHERE {where} AND NOT (source = 'registros' AND row_id IS ?)
+        LIMIT ?
+    """, (*params, exclude_id, DUPLICATE_WARN_LIMIT + 1))
+    return c.fetchall()
+
+def flash_duplicates(matches):
+    if not matches:
+        return
+    described = []
+    for source, row_id, office_key in matches[:DUPLICATE_WARN_LIMIT]:
+        office = (office_key or "")[len("office_"):] if (office_key or "").startswith("office_") else (office_key or "?")
+        described.append(f"#{row_id} ({office}{', excluído' if source == 'excluidos' else ''})")
+    more = " e outros" if len(matches) > DUPLICATE_WARN_LIMIT else ""
+    flash("Atenção: possível cliente duplicado (mesmo CPF ou nome): " + ", ".join(described) + more + ".", "warning")
+
+@app.route("/duplicados")
+@login_required
+@require_roles("ADMIN", "SUPERVISOR")
+def duplicados():
+    """Clients registered more than once, grouped by identity, across both tables."""
+    try:
+        page = max(1, int(request.args.get("page", "1") or 1))
+    except ValueError:
+        page = 1
+    per_page = DUPLICADOS_PER_PAGE
+    conn = get_conn()
+    c = conn.cursor()
+    # one GROUP BY walking idx_identidades_key in order (no temp b-tree)
+    c.execute("""
+        SELECT identity_key, COUNT(*), GROUP_CONCAT(source || ':' || row_id)
+        FROM identidades WHERE identity_key IS NOT NULL
+        GROUP BY identity_key HAVING COUNT(*) > 1
+        ORDER BY identity_key LIMIT ? OFFSET ?
+    """, (per_page + 1, (page - 1) * per_page))
+    found = c.fetchall()
+    has_next = len(found) > per_page
+    found = found[:per_page]
+
+    ids = {"registros": set(), "excluidos": set()}
+    for _, _, members in found:
+        for m in members.split(","):
+            source, row_id = m.split(":")
+            ids[source].add(int(row_id))
+    rows = {}
+    for source, office_col in (("registros", "escritorio_nome"), ("excluidos", "escritorio_origem")):
+        if ids[source]:
+            marks = ",".join("?" * len(ids[source]))
+            c.execute(f"SELECT id, nome, cpf, {office_col} FROM {source} WHERE id IN ({marks})", tuple(ids[source]))
+            for r in c.fetchall():
+                rows[(source, r[0])] = {"source": source, "id": r[0], "nome": r[1], "cpf": r[2], "escritorio": r[3]}
+    conn.close()
+
+    groups = []
+    for key, count, members in found:
+        kind, _, value = key.partition(":")
+        items = []
+        for m in members.split(","):
+            source, row_id = m.split(":")
+            if (source, int(row_id)) in rows:
+                items.append(rows[(source, int(row_id))])
+        groups.append({"kind": "CPF" if kind == "cpf" else "Nome", "value": value, "count": count, "members": items})
+    return render_template("duplicados.html", groups=groups, page=page, has_next=has_next)
+
 # -------------------------
 # Index / create record
 # -------------------------
 @app.route("/")
 @login_required
 def index():
-    offices = list_offices()
+    offices = visible_offices()
     return render_template("index.html", offices=offices)
 
+def _submit_job(c, office_key, new_office_display, values):
+    # office registration and insert share one transaction
+    if new_office_display:
+        register_office(office_key, new_office_display, c=c)
+    c.execute("""
+        INSERT INTO registros (nome, cpf, escritorio_chave, escritorio_nome, tipo_acao, data_fechamento, pendencias,
+                              numero_processo, data_protocolo, observacoes, captador, created_at, updated_at,
+                              nome_norm, cpf_norm)
+        VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)
+    """, values)
+    return c.lastrowid
+
 @app.route("/submit", methods=["POST"])
 @login_required
 def submit():
@@ -294,13 +1094,18 @@ def submit():
     c = conn.cursor()
     c.execute("SELECT office_key FROM offices WHERE display_name = ?", (escritorio_input.upper(),))
     found = c.fetchone()
+    duplicates = find_duplicates(c, nome, cpf)
+    conn.close()
+    new_office = not found
     if found:
         office_key = found[0]
         display_name = get_office_display(office_key)
     else:
         office_key = normalize_office_key(escritorio_input)
         display_name = escritorio_input.upper() or get_office_display(office_key)
-        register_office(office_key, display_name)
+    if not can_access_office(office_key):
+        flash("Sem acesso a este escritório.", "error")
+        return redirect(url_for("index"))
 
     tipo_acao = request.form.get("tipo_acao")
     data_fechamento = request.form.get("data_fechamento")
@@ -311,19 +1116,51 @@ def submit():
     captador = request.form.get("captador")
 
     now = datetime.utcnow().isoformat()
-    c.execute("""
-        INSERT INTO registros (nome, cpf, escritorio_chave, escritorio_nome, tipo_acao, data_fechamento, pendencias,
-                              numero_processo, data_protocolo, observacoes, captador, created_at)
-        VALUES (?,?,?,?,?,?,?,?,?,?,?,?)
-    """, (nome, cpf, f"office_{office_key}", display_name, tipo_acao, data_fechamento, pendencias, numero_processo, data_protocolo, observacoes, captador, now))
-    conn.commit()
-    conn.close()
+    values = (nome, cpf, f"office_{office_key}", display_name, tipo_acao, data_fechamento, pendencias, numero_processo, data_protocolo, observacoes, captador, now, now,
+              fold_name(nome), cpf_digits(cpf))
+    run_write(_submit_job, office_key, display_name if new_office else None, values)
     flash("Registro salvo com sucesso.", "success")
+    flash_duplicates(duplicates)
     return redirect(url_for("table", office=office_key))
 
 # -------------------------
 # Table listing + filters + pagination
 # -------------------------
+def encode_cursor(key, row_id):
+    """Opaque ?after= token for keyset pagination: the last row's (sort key, id)."""
+    return base64.urlsafe_b64encode(json.dumps([key, row_id]).encode()).decode().rstrip("=")
+
+def _sqlite_int(value):
+    return isinstance(value, int) and -2**63 <= value < 2**63
+
+def decode_cursor(token):
+    """(key, id) from an ?after= token, or None if it isn't one we could have made."""
+    try:
+        key, row_id = json.loads(base64.urlsafe_b64decode(token + "=" * (-len(token) % 4)))
+    except (ValueError, TypeError):
+        return None
+    if isinstance(key, bool) or not (key is None or isinstance(key, str) or _sqlite_int(key)
+                                     or (isinstance(key, float) and math.isfinite(key))):
+        return None
+    if isinstance(row_id, bool) or not _sqlite_int(row_id):
+        return None
+    return key, row_id
+
+def _keyset_segments(col, asc, key, row_id):
+    """Predicates, in sort order, for the rows after (key, row_id) in ORDER BY col, id.
+
+    NULL keys sort first, so the rows past the cursor are split at the NULL
+    block; each part is then a plain range seek on the sort index.
+    """
+    op = ">" if asc else "<"
+    if col == "id":
+        return [(f"id {op} ?", [row_id])]
+    if key is None:
+        nulls = (f"{col} IS NULL AND id {op} ?", [row_id])
+        return [nulls, (f"{col} IS NOT NULL", [])] if asc else [nulls]
+    values = (f"{col} {op}= ? AND ({col} {op} ? OR id {op} ?)", [key, key, row_id])
+    return [values] if asc else [values, (f"{col} IS NULL", [])]
+
 @app.route("/table")
 @login_required
 def table():
@@ -337,100 +1174,171 @@ def table():
     data_tipo = request.args.get("data_tipo")
     data_de = request.args.get("data_de")
     data_ate = request.args.get("data_ate")
+    sort = request.args.get("sort", "id")
+    if sort not in TABLE_SORTS:
+        sort = "id"
+    direction = "asc" if request.args.get("dir") == "asc" else "desc"
+    after = decode_cursor(request.args.get("after", ""))
 
-    offices = list_offices()
-    conn = get_conn()
-    c = conn.cursor()
+    show_all = office_param.upper() == "ALL"
+    if not show_all and not can_access_office(office_param):
+        acl = allowed_offices()
+        if acl:
+            flash("Sem acesso a este escritório.", "error")
+            return redirect(url_for("table", office=acl[0]))
+        flash("Nenhum escritório atribuído ao seu usuário.", "error")
+        return redirect(url_for("index"))
 
-    rows = []
-    total = 0
-    if office_param == "ALL" or office_param == "ALL" or office_param.upper() == "ALL":
-        # aggregate from registros
-        where = []
-        params = []
-        if filtro and valor:
-            if filtro == "nome":
-                where.append("LOWER(nome) LIKE ?")
-                params.append(f"%{valor.lower()}%")
-            elif filtro == "cpf":
-                where.append("cpf LIKE ?")
-                params.append(f"%{valor}%")
-            elif filtro == "id":
-                try:
-                    _id = int(valor)
-                    where.append("id = ?")
-                    params.append(_id)
-                except:
-                    where.append("1=0")
-        if data_tipo in ("data_fechamento", "data_protocolo") and (data_de or data_ate):
-            if data_de and data_ate:
-                where.append(f"{data_tipo} BETWEEN ? AND ?")
-                params.extend([data_de, data_ate])
-            elif data_de:
-                where.append(f"{data_tipo} >= ?")
-                params.append(data_de)
-            elif data_ate:
-                where.append(f"{data_tipo} <= ?")
-                params.append(data_ate)
-        where_sql = "WHERE " + " AND ".join(where) if where else ""
-        q = f"SELECT * FROM registros {where_sql} ORDER BY id DESC"
-        c.execute(q, tuple(params))
-        allrows = c.fetchall()
-        total = len(allrows)
-        start = (page-1)*per_page
-        rows = allrows[start:start+per_page]
+    offices = visible_offices()
+    where = []
+    params = []
+    if show_all:
+        # ALL = every office the user may see
+        scope_sql, scope_params = office_scope_sql()
+        where.append(scope_sql)
+        params.extend(scope_params)
     else:
-        office_key = normalize_office_key(office_param)
-        # we store escritorio_chave as "office_<key>" in records; match either
-        where = []
-        params = []
+        # we store escritorio_chave as "office_<key>" in records
         where.append("escritorio_chave = ?")
-        params.append(f"office_{office_key}")
-        if filtro and valor:
-            if filtro == "nome":
-                where.append("LOWER(nome) LIKE ?")
-                params.append(f"%{valor.lower()}%")
-            elif filtro == "cpf":
-                where.append("cpf LIKE ?")
-                params.append(f"%{valor}%")
-            elif filtro == "id":
-                try:
-                    _id = int(valor)
-                    where.append("id = ?")
-                    params.append(_id)
-                except:
-                    where.append("1=0")
-        if data_tipo in ("data_fechamento", "data_protocolo") and (data_de or data_ate):
-            if data_de and data_ate:
-                where.append(f"{data_tipo} BETWEEN ? AND ?")
-                params.extend([data_de, data_ate])
-            elif data_de:
-                where.append(f"{data_tipo} >= ?")
-                params.append(data_de)
-            elif data_ate:
-                where.append(f"{data_tipo} <= ?")
-                params.append(data_ate)
-        where_sql = "WHERE " + " AND ".join(where)
-        count_q = f"SELECT COUNT(*) FROM registros {where_sql}"
-        try:
-            c.execute(count_q, tuple(params))
-            total = c.fetchone()[0]
-        except:
-            total = 0
-        total_pages = max(1, (total + per_page -1)//per_page)
-        if page < 1: page = 1
-        if page > total_pages: page = total_pages
-        offset = (page-1)*per_page
-        q = f"SELECT * FROM registros {where_sql} ORDER BY id DESC LIMIT ? OFFSET ?"
-        c.execute(q, tuple(params + [per_page, offset]))
-        rows = c.fetchall()
+        params.append(f"office_{normalize_office_key(office_param)}")
+    if filtro and valor:
+        if filtro == "nome":
+            where.append("LOWER(nome) LIKE ?")
+            params.append(f"%{valor.lower()}%")
+        elif filtro == "cpf":
+            where.append("cpf LIKE ?")
+            params.append(f"%{valor}%")
+        elif filtro == "id":
+            try:
+                _id = int(valor)
+                where.append("id = ?")
+                params.append(_id)
+            except:
+                where.append("1=0")
+    if data_tipo in ("data_fechamento", "data_protocolo") and (data_de or data_ate):
+        if data_de and data_ate:
+            where.append(f"{data_tipo} BETWEEN ? AND ?")
+            params.extend([data_de, data_ate])
+        elif data_de:
+            where.append(f"{data_tipo} >= ?")
+            params.append(data_de)
+        elif data_ate:
+            where.append(f"{data_tipo} <= ?")
+            params.append(data_ate)
+    where_sql = "WHERE " + " AND ".join(where)
 
-    conn.close()
+    conn = get_conn()
+    c = conn.cursor()
+    count_q = f"SELECT COUNT(*) FROM registros {where_sql}"
+    try:
+        c.execute(count_q, tuple(params))
+        total = c.fetchone()[0]
+    except:
+        total = 0
     total_pages = max(1, (total + per_page -1)//per_page)
-    return render_template("table.html",
+    if page < 1: page = 1
+    if page > total_pages: page = total_pages
+    offset = (page-1)*per_page
+
+    col = TABLE_SORTS[sort]
+    order = "ASC" if direction == "asc" else "DESC"
+    order_sql = f"id {order}" if col == "id" else f"{col} {order}, id {order}"
+    # deferred join: pick the page's ids off the sort index, then fetch just those rows
+    if after:
+        # keyset: continue right after the previous page's last row, no OFFSET walk
+        keys = []
+        for seg_sql, seg_params in _keyset_segments(col, direction == "asc", *after):
+            c.execute(f"SELECT id, {col} FROM registros {where_sql} AND {seg_sql} ORDER BY {order_sql} LIMIT ?",
+                      tuple(params + seg_params + [per_page - len(keys)]))
+            keys += c.fetchall()
+            if len(keys) >= per_page:
+                break
+    else:
+        c.execute(f"SELECT id, {col} FROM registros {where_sql} ORDER BY {order_sql} LIMIT ? OFFSET ?",
+                  tuple(params + [per_page, offset]))
+        keys = c.fetchall()
+    rows = []
+    if keys:
+        c.execute(f"SELECT * FROM registros WHERE id IN ({','.join('?' * len(keys))})", tuple(k[0] for k in keys))
+        by_id = {r[0]: r for r in c.fetchall()}
+        rows = [by_id[k[0]] for k in keys if k[0] in by_id]
+    conn.close()
+    next_after = encode_cursor(keys[-1][1], keys[-1][0]) if len(keys) == per_page else None
+
+    # query string the pagination links carry along (filters survive page flips)
+    page_args = {k: v for k, v in (("office", office_param), ("per_page", per_page), ("filtro", filtro), ("valor", valor),
+                                   ("data_tipo", data_tipo), ("data_de", data_de), ("data_ate", data_ate)) if v}
+    if (sort, direction) != ("id", "desc"):
+        page_args.update(sort=sort, dir=direction)
+    # ?partial=1: only <tbody> + pagination, for in-place swaps by script.js
+    template = "table_fragment.html" if request.args.get("partial") == "1" else "table.html"
+    return render_template(template,
                            rows=rows, office=office_param, offices=offices,
                            page=page, per_page=per_page, total=total, total_pages=total_pages,
-                           filtro=filtro, valor=valor, data_tipo=data_tipo, data_de=data_de, data_ate=data_ate)
+                           filtro=filtro, valor=valor, data_tipo=data_tipo, data_de=data_de, data_ate=data_ate,
+                           sort=sort, direction=direction, next_after=next_after, page_args=page_args)
+
+# -------------------------
+# Typeahead search (JSON)
+# -------------------------
+SEARCH_DEFAULT_LIMIT = 8
+SEARCH_MAX_LIMIT = 20
+
+def _prefix_range(prefix):
+    """[prefix, upper) is an index range scan under BINARY collation; upper is None
+    when nothing sorts after the prefix (it is all U+10FFFF)."""
+    stem = prefix.rstrip("\U0010ffff")
+    if not stem:
+        return prefix, None
+    nxt = ord(stem[-1]) + 1
+    if 0xD800 <= nxt <= 0xDFFF:
+        nxt = 0xE000  # surrogates can't be stored; the next storable code point
+    return prefix, stem[:-1] + chr(nxt)
+
+@app.route("/api/search")
+@login_required
+def search_api():
+    """Top matches for a name or CPF prefix, for the table filter autocomplete."""
+    q = request.args.get("q", "").strip()
+    office = request.args.get("office", "CENTRAL")
+    try:
+        limit = int(request.args.get("limit", SEARCH_DEFAULT_LIMIT))
+    except ValueError:
+        limit = SEARCH_DEFAULT_LIMIT
+    limit = max(1, min(limit, SEARCH_MAX_LIMIT))
+
+    digits = cpf_digits(q)
+    if digits and not re.sub(r"[\d.\-/\s]", "", q):
+        column, key = "cpf_norm", digits
+    else:
+        column, key = "nome_norm", fold_name(q)
+    if len(key) < 2:
+        return jsonify({"results": []})
+
+    lo, hi = _prefix_range(key)
+    where = [f"{column} >= ?"]
+    params = [lo]
+    if hi is not None:
+        where.append(f"{column} < ?")
+        params.append(hi)
+    if office.upper() == "ALL":
+        scope_sql, scope_params = office_scope_sql()
+        where.insert(0, scope_sql)
+        params = scope_params + params
+    elif can_access_office(office):
+        where.insert(0, "escritorio_chave = ?")
+        params.insert(0, f"office_{normalize_office_key(office)}")
+    else:
+        return jsonify({"results": []})
+    conn = get_conn()
+    c = conn.cursor()
+    c.execute(f"""
+        SELECT id, nome, cpf, escritorio_nome FROM registros
+        WHERE {" AND ".join(where)} ORDER BY {column} LIMIT ?
+    """, tuple(params + [limit]))
+    rows = c.fetchall()
+    conn.close()
+    return jsonify({"results": [{"id": r[0], "nome": r[1], "cpf": r[2], "escritorio": r[3]} for r in rows]})
 
 # -------------------------
 # Edit / Update record
@@ -440,9 +1348,10 @@ def table():
 def edit():
     registro_id = request.args.get("id")
     office = request.args.get("office", "CENTRAL")
+    scope_sql, scope_params = office_scope_sql()
     conn = get_conn()
     c = conn.cursor()
-    c.execute("SELECT * FROM registros WHERE id=?", (registro_id,))
+    c.execute(f"SELECT * FROM registros WHERE id=? AND {scope_sql}", (registro_id, *scope_params))
     row = c.fetchone()
     conn.close()
     if not row:
@@ -453,9 +1362,20 @@ def edit():
         "tipo_acao": row[5], "data_fechamento": row[6], "pendencias": row[7], "numero_processo": row[8],
         "data_protocolo": row[9], "observacoes": row[10], "captador": row[11], "created_at": row[12]
     }
-    offices = list_offices()
+    offices = visible_offices()
     return render_template("edit.html", cliente=cliente, office=office, offices=offices)
 
+def _update_job(c, office_key, new_office_display, values, scope):
+    if new_office_display:
+        register_office(office_key, new_office_display, c=c)
+    scope_sql, scope_params = scope
+    c.execute(f"""
+        UPDATE registros SET nome=?, cpf=?, escritorio_chave=?, escritorio_nome=?, tipo_acao=?, data_fechamento=?, pendencias=?, numero_processo=?, data_protocolo=?, observacoes=?, captador=?, updated_at=?,
+            nome_norm=?, cpf_norm=?
+        WHERE id=? AND {scope_sql}
+    """, (*values, *scope_params))
+    return c.rowcount
+
 @app.route("/update", methods=["POST"])
 @login_required
 def update():
@@ -466,13 +1386,18 @@ def update():
     c = conn.cursor()
     c.execute("SELECT office_key FROM offices WHERE display_name = ?", (office_input.upper(),))
     found = c.fetchone()
+    duplicates = find_duplicates(c, request.form.get("nome"), request.form.get("cpf"), exclude_id=registro_id)
+    conn.close()
+    new_office = not found
     if found:
         office_key = found[0]
         display_name = get_office_display(office_key)
     else:
         office_key = normalize_office_key(office_input) if office_input else normalize_office_key(request.form.get("office","CENTRAL"))
         display_name = office_input.upper() or get_office_display(office_key)
-        register_office(office_key, display_name)
+    if not can_access_office(office_key):
+        flash("Sem acesso a este escritório.", "error")
+        return redirect(url_for("table", office=request.form.get("office", "CENTRAL")))
 
     nome = request.form.get("nome")
     cpf = request.form.get("cpf")
@@ -484,13 +1409,13 @@ def update():
     observacoes = request.form.get("observacoes")
     captador = request.form.get("captador")
 
-    c.execute("""
-        UPDATE registros SET nome=?, cpf=?, escritorio_chave=?, escritorio_nome=?, tipo_acao=?, data_fechamento=?, pendencias=?, numero_processo=?, data_protocolo=?, observacoes=?, captador=?
-        WHERE id=?
-    """, (nome, cpf, f"office_{office_key}", display_name, tipo_acao, data_fechamento, pendencias, numero_processo, data_protocolo, observacoes, captador, registro_id))
-    conn.commit()
-    conn.close()
+    values = (nome, cpf, f"office_{office_key}", display_name, tipo_acao, data_fechamento, pendencias, numero_processo, data_protocolo, observacoes, captador, datetime.utcnow().isoformat(),
+              fold_name(nome), cpf_digits(cpf), registro_id)
+    if not run_write(_update_job, office_key, display_name if new_office else None, values, office_scope_sql()):
+        flash("Registro não encontrado.", "error")
+        return redirect(url_for("table", office=request.form.get("office", "CENTRAL")))
     flash("Registro atualizado.", "success")
+    flash_duplicates(duplicates)
     return redirect(url_for("table", office=office_key))
 
 # -------------------------
@@ -501,17 +1426,20 @@ def update():
 def delete():
     registro_id = request.form.get("id")
     office = request.form.get("office", "CENTRAL")
+    scope_sql, scope_params = office_scope_sql()
     conn = get_conn()
     c = conn.cursor()
-    c.execute("SELECT * FROM registros WHERE id=?", (registro_id,))
+    c.execute(f"SELECT * FROM registros WHERE id=? AND {scope_sql}", (registro_id, *scope_params))
     row = c.fetchone()
     if row:
         escritorio_nome = row[4] if row[4] else get_office_display(normalize_office_key(office))
         escritorio_chave = row[3] if row[3] else f"office_{normalize_office_key(office)}"
+        now = datetime.utcnow().isoformat()
         c.execute("""
-            INSERT INTO excluidos (nome, cpf, escritorio_origem, escritorio_origem_chave, tipo_acao, data_fechamento, pendencias, numero_processo, data_protocolo, observacoes, captador, created_at, data_exclusao)
-            VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?)
-        """, (row[1], row[2], escritorio_nome, escritorio_chave, row[5], row[6], row[7], row[8], row[9], row[10], row[11], row[12], datetime.utcnow().isoformat()))
+            INSERT INTO excluidos (nome, cpf, escritorio_origem, escritorio_origem_chave, tipo_acao, data_fechamento, pendencias, numero_processo, data_protocolo, observacoes, captador, created_at, data_exclusao, updated_at, nome_norm, cpf_norm)
+            VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)
+        """, (row[1], row[2], escritorio_nome, escritorio_chave, row[5], row[6], row[7], row[8], row[9], row[10], row[11], row[12], now, now,
+              fold_name(row[1]), cpf_digits(row[2])))
         c.execute("DELETE FROM registros WHERE id=?", (registro_id,))
         conn.commit()
         flash("Registro excluído.", "success")
@@ -520,25 +1448,29 @@ def delete():
 
 @app.route("/delete_selected", methods=["POST"])
 @login_required
+@limit_concurrency("bulk")
 def delete_selected():
     ids = request.form.getlist("ids")
     office = request.form.get("office", "CENTRAL")
     if not ids:
         flash("Nenhum registro selecionado.", "error")
         return redirect(url_for("table", office=office))
+    scope_sql, scope_params = office_scope_sql()
     conn = get_conn()
     c = conn.cursor()
     for registro_id in ids:
-        c.execute("SELECT * FROM registros WHERE id=?", (registro_id,))
+        c.execute(f"SELECT * FROM registros WHERE id=? AND {scope_sql}", (registro_id, *scope_params))
         row = c.fetchone()
         if not row:
             continue
         escritorio_nome = row[4] if row[4] else get_office_display(normalize_office_key(office))
         escritorio_chave = row[3] if row[3] else f"office_{normalize_office_key(office)}"
+        now = datetime.utcnow().isoformat()
         c.execute("""
-            INSERT INTO excluidos (nome, cpf, escritorio_origem, escritorio_origem_chave, tipo_acao, data_fechamento, pendencias, numero_processo, data_protocolo, observacoes, captador, created_at, data_exclusao)
-            VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?)
-        """, (row[1], row[2], escritorio_nome, escritorio_chave, row[5], row[6], row[7], row[8], row[9], row[10], row[11], row[12], datetime.utcnow().isoformat()))
+            INSERT INTO excluidos (nome, cpf, escritorio_origem, escritorio_origem_chave, tipo_acao, data_fechamento, pendencias, numero_processo, data_protocolo, observacoes, captador, created_at, data_exclusao, updated_at, nome_norm, cpf_norm)
+            VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)
+        """, (row[1], row[2], escritorio_nome, escritorio_chave, row[5], row[6], row[7], row[8], row[9], row[10], row[11], row[12], now, now,
+              fold_name(row[1]), cpf_digits(row[2])))
         c.execute("DELETE FROM registros WHERE id=?", (registro_id,))
     conn.commit()
     conn.close()
@@ -579,9 +1511,10 @@ def restore():
             office_key = normalize_office_key(origem_display)
         register_office(office_key, origem_display)
         c.execute("""
-            INSERT INTO registros (nome, cpf, escritorio_chave, escritorio_nome, tipo_acao, data_fechamento, pendencias, numero_processo, data_protocolo, observacoes, captador, created_at)
-            VALUES (?,?,?,?,?,?,?,?,?,?,?,?)
-        """, (row[1], row[2], f"office_{office_key}", origem_display, row[5], row[6], row[7], row[8], row[9], row[10], row[11], row[12]))
+            INSERT INTO registros (nome, cpf, escritorio_chave, escritorio_nome, tipo_acao, data_fechamento, pendencias, numero_processo, data_protocolo, observacoes, captador, created_at, updated_at, nome_norm, cpf_norm)
+            VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)
+        """, (row[1], row[2], f"office_{office_key}", origem_display, row[5], row[6], row[7], row[8], row[9], row[10], row[11], row[12], datetime.utcnow().isoformat(),
+              fold_name(row[1]), cpf_digits(row[2])))
         c.execute("DELETE FROM excluidos WHERE id=?", (registro_id,))
         conn.commit()
         flash("Registro restaurado.", "success")
@@ -591,6 +1524,7 @@ def restore():
 @app.route("/restore_selected", methods=["POST"])
 @login_required
 @require_roles("ADMIN", "SUPERVISOR")
+@limit_concurrency("bulk")
 def restore_selected():
     ids = request.form.getlist("ids")
     conn = get_conn()
@@ -608,9 +1542,10 @@ def restore_selected():
             office_key = normalize_office_key(origem_display)
         register_office(office_key, origem_display)
         c.execute("""
-            INSERT INTO registros (nome, cpf, escritorio_chave, escritorio_nome, tipo_acao, data_fechamento, pendencias, numero_processo, data_protocolo, observacoes, captador, created_at)
-            VALUES (?,?,?,?,?,?,?,?,?,?,?,?)
-        """, (row[1], row[2], f"office_{office_key}", origem_display, row[5], row[6], row[7], row[8], row[9], row[10], row[11], row[12]))
+            INSERT INTO registros (nome, cpf, escritorio_chave, escritorio_nome, tipo_acao, data_fechamento, pendencias, numero_processo, data_protocolo, observacoes, captador, created_at, updated_at, nome_norm, cpf_norm)
+            VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)
+        """, (row[1], row[2], f"office_{office_key}", origem_display, row[5], row[6], row[7], row[8], row[9], row[10], row[11], row[12], datetime.utcnow().isoformat(),
+              fold_name(row[1]), cpf_digits(row[2])))
         c.execute("DELETE FROM excluidos WHERE id=?", (registro_id,))
     conn.commit()
     conn.close()
@@ -634,6 +1569,7 @@ def delete_forever():
 @app.route("/delete_forever_selected", methods=["POST"])
 @login_required
 @require_roles("ADMIN")
+@limit_concurrency("bulk")
 def delete_forever_selected():
     ids = request.form.getlist("ids")
     conn = get_conn()
@@ -657,9 +1593,13 @@ def migrate():
     if not office_target:
         flash("Destino inválido.", "error")
         return redirect(url_for("table", office=office_current))
+    if not can_access_office(office_target):
+        flash("Sem acesso ao escritório de destino.", "error")
+        return redirect(url_for("table", office=office_current))
+    scope_sql, scope_params = office_scope_sql()
     conn = get_conn()
     c = conn.cursor()
-    c.execute("SELECT * FROM registros WHERE id=?", (registro_id,))
+    c.execute(f"SELECT * FROM registros WHERE id=? AND {scope_sql}", (registro_id, *scope_params))
     row = c.fetchone()
     if not row:
         flash("Registro não encontrado.", "error")
@@ -669,8 +1609,8 @@ def migrate():
     target_display = office_target.upper()
     register_office(target_key, target_display)
     c.execute("""
-        UPDATE registros SET escritorio_chave=?, escritorio_nome=? WHERE id=?
-    """, (f"office_{target_key}", target_display, registro_id))
+        UPDATE registros SET escritorio_chave=?, escritorio_nome=?, updated_at=? WHERE id=?
+    """, (f"office_{target_key}", target_display, datetime.utcnow().isoformat(), registro_id))
     conn.commit()
     conn.close()
     flash("Registro movido com sucesso.", "success")
@@ -678,6 +1618,7 @@ def migrate():
 
 @app.route("/migrate_selected", methods=["POST"])
 @login_required
+@limit_concurrency("bulk")
 def migrate_selected():
     ids = request.form.getlist("ids")
     office_current = request.form.get("office_current", "CENTRAL")
@@ -685,13 +1626,19 @@ def migrate_selected():
     if not ids or not office_target:
         flash("Nada selecionado ou destino inválido.", "error")
         return redirect(url_for("table", office=office_current))
+    if not can_access_office(office_target):
+        flash("Sem acesso ao escritório de destino.", "error")
+        return redirect(url_for("table", office=office_current))
     target_key = normalize_office_key(office_target)
     target_display = office_target.upper()
     register_office(target_key, target_display)
+    now = datetime.utcnow().isoformat()
+    scope_sql, scope_params = office_scope_sql()
     conn = get_conn()
     c = conn.cursor()
     for registro_id in ids:
-        c.execute("UPDATE registros SET escritorio_chave=?, escritorio_nome=? WHERE id=?", (f"office_{target_key}", target_display, registro_id))
+        c.execute(f"UPDATE registros SET escritorio_chave=?, escritorio_nome=?, updated_at=? WHERE id=? AND {scope_sql}",
+                  (f"office_{target_key}", target_display, now, registro_id, *scope_params))
     conn.commit()
     conn.close()
     flash("Registros movidos com sucesso.", "success")
@@ -768,21 +1715,48 @@ def offices_delete():
 # -------------------------
 # Users admin
 # -------------------------
+ADMIN_USERS_PER_PAGE = 50
+
 @app.route("/admin/users")
 @login_required
 @require_roles("ADMIN")
 def admin_users():
+    q = request.args.get("q", "").strip()
+    try:
+        page = max(1, int(request.args.get("page", "1") or 1))
+    except ValueError:
+        page = 1
+    per_page = ADMIN_USERS_PER_PAGE
+
+    where_sql = ""
+    params = []
+    if q:
+        like = f"%{q}%"
+        where_sql = """WHERE u.username LIKE ? OR u.full_name LIKE ? OR u.role LIKE ?
+                       OR EXISTS (SELECT 1 FROM user_offices s WHERE s.user_id = u.id AND s.office_key LIKE ?)"""
+        params = [like, like, like, like]
+
+    # two queries whatever the number of users: the count, and one page of
+    # users with their offices aggregated in the same statement
     conn = get_conn()
     c = conn.cursor()
-    c.execute("SELECT id, username, full_name, role, active, created_at FROM users ORDER BY id DESC")
-    rows = c.fetchall()
+    c.execute(f"SELECT COUNT(*) FROM users u {where_sql}", tuple(params))
+    total = c.fetchone()[0]
+    total_pages = max(1, (total + per_page - 1) // per_page)
+    page = min(page, total_pages)
+    c.execute(f"""
+        SELECT u.id, u.username, u.full_name, u.role, u.active, u.created_at, GROUP_CONCAT(uo.office_key)
+        FROM (SELECT * FROM users u {where_sql} ORDER BY u.id DESC LIMIT ? OFFSET ?) u
+        LEFT JOIN user_offices uo ON uo.user_id = u.id
+        GROUP BY u.id
+        ORDER BY u.id DESC
+    """, tuple(params + [per_page, (page - 1) * per_page]))
     users = []
-    for r in rows:
-        uid = r[0]
-        u_offs = get_user_offices(uid)
-        users.append({"id": uid, "username": r[1], "full_name": r[2], "role": r[3], "active": r[4], "created_at": r[5], "offices": u_offs})
+    for r in c.fetchall():
+        u_offs = sorted(r[6].split(",")) if r[6] else []
+        users.append({"id": r[0], "username": r[1], "full_name": r[2], "role": r[3], "active": r[4], "created_at": r[5], "offices": u_offs})
     conn.close()
-    return render_template("admin_users.html", users=users)
+    return render_template("admin_users.html", users=users, q=q, page=page, total=total, total_pages=total_pages)
 
 @app.route("/admin/users/create", methods=["GET", "POST"])
 @login_required
@@ -797,7 +1771,7 @@ def admin_users_create():
         if not username or not password:
             flash("Username e senha são obrigatórios.", "error")
             return redirect(url_for("admin_users_create"))
-        pw_hash = generate_password_hash(password)
+        pw_hash = hash_password(password)
         now = datetime.utcnow().isoformat()
         conn = get_conn()
         c = conn.cursor()
@@ -805,8 +1779,8 @@ def admin_users_create():
             c.execute("INSERT INTO users (username, full_name, password_hash, role, active, created_at) VALUES (?,?,?,?,?,?)",
                       (username, full_name, pw_hash, role, 1, now))
             uid = c.lastrowid
-            for ok in offices_sel:
-                c.execute("INSERT OR IGNORE INTO user_offices (user_id, office_key) VALUES (?,?)", (uid, ok))
+            c.executemany("INSERT OR IGNORE INTO user_offices (user_id, office_key) VALUES (?,?)",
+                          [(uid, ok) for ok in offices_sel])
             conn.commit()
             flash("Usuário criado.", "success")
             return redirect(url_for("admin_users"))
@@ -860,8 +1834,9 @@ def admin_users_offices(user_id):
         c = conn.cursor()
         try:
             c.execute("DELETE FROM user_offices WHERE user_id=?", (user_id,))
-            for ok in selected:
-                c.execute("INSERT INTO user_offices (user_id, office_key) VALUES (?,?)", (user_id, ok))
+            c.executemany("INSERT OR IGNORE INTO user_offices (user_id, office_key) VALUES (?,?)",
+                          [(user_id, ok) for ok in selected])
+            c.execute("UPDATE users SET acl_version = COALESCE(acl_version, 0) + 1 WHERE id=?", (user_id,))
             conn.commit()
             flash("Escritórios atribuídos atualizados.", "success")
         except Exception as e:
@@ -882,7 +1857,7 @@ def admin_users_reset_password(user_id):
     if not newpass:
         flash("Senha nova obrigatória.", "error")
         return redirect(url_for("admin_users"))
-    pw_hash = generate_password_hash(newpass)
+    pw_hash = hash_password(newpass)
     conn = get_conn()
     c = conn.cursor()
     try:
@@ -915,63 +1890,726 @@ def admin_users_delete(user_id):
     return redirect(url_for("admin_users"))
 
 # -------------------------
-# Export CSV / PDF
+# Change feed (downstream sync)
 # -------------------------
-@app.route("/export/csv")
-@login_required
-def export_csv():
-    office = request.args.get("office", "CENTRAL")
+CHANGES_BATCH = 500
+CHANGES_MAX_LIMIT = 100000
+
+def _rows_by_id(c, table_name, ids):
+    if not ids:
+        return {}
+    marks = ",".join("?" * len(ids))
+    c.execute(f"SELECT * FROM {table_name} WHERE id IN ({marks})", tuple(ids))
+    cols = [d[0] for d in c.description]
+    return {r[0]: dict(zip(cols, r)) for r in c.fetchall()}
+
+def iter_changes(since, limit):
+    """Yield change_log entries with seq > since, oldest first, as dicts.
+
+    Each entry carries the row's *current* state (None once it is gone from
+    that table), so replaying the feed in order converges on the live data.
+    """
     conn = get_conn()
-    c = conn.cursor()
-    rows = []
-    if office.upper() == "ALL":
-        c.execute("SELECT * FROM registros")
-        rows = c.fetchall()
-    else:
-        key = normalize_office_key(office)
-        c.execute("SELECT * FROM registros WHERE escritorio_chave=?", (f"office_{key}",))
-        rows = c.fetchall()
-    conn.close()
-    output = io.StringIO()
-    writer = csv.writer(output, delimiter=";")
-    writer.writerow(["id","nome","cpf","escritorio_chave","escritorio_nome","tipo_acao","data_fechamento","pendencias","numero_processo","data_protocolo","observacoes","captador","created_at"])
-    for r in rows:
-        writer.writerow([str(x) for x in r])
-    mem = io.BytesIO(output.getvalue().encode("utf-8"))
-    return send_file(mem, as_attachment=True, download_name=f"{office}_export.csv", mimetype="text/csv")
+    try:
+        c = conn.cursor()
+        sent = 0
+        while sent < limit:
+            c.execute("""
+                SELECT seq, table_name, row_id, op, escritorio_chave, escritorio_origem, changed_at
+                FROM change_log WHERE seq > ? ORDER BY seq LIMIT ?
+            """, (since, min(CHANGES_BATCH, limit - sent)))
+            batch = c.fetchall()
+            if not batch:
+                break
+            current = {
+                t: _rows_by_id(c, t, sorted({b[2] for b in batch if b[1] == t}))
+                for t in ("registros", "excluidos")
+            }
+            for seq, table_name, row_id, op, office_key, office_from, changed_at in batch:
+                yield {
+                    "seq": seq, "table": table_name, "id": row_id, "op": op,
+                    "escritorio_chave": office_key, "escritorio_origem": office_from,
+                    "changed_at": changed_at, "row": current.get(table_name, {}).get(row_id),
+                }
+            since = batch[-1][0]
+            sent += len(batch)
+    finally:
+        conn.close()
 
-@app.route("/export/pdf")
+@app.route("/changes")
 @login_required
-def export_pdf():
-    office = request.args.get("office", "CENTRAL")
+@require_roles("ADMIN", "SUPERVISOR")
+@limit_concurrency("exports")
+def changes():
+    """JSONL stream of changes after ?since=<seq> (0 = from the beginning).
+
+    Clients keep the last "seq" they processed and pass it back next time.
+    Rows that predate the change log never appear here, so a new consumer
+    should take one full export first and then follow the feed.
+    """
+    try:
+        since = max(0, int(request.args.get("since", "0") or 0))
+        limit = int(request.args.get("limit", str(CHANGES_MAX_LIMIT)) or CHANGES_MAX_LIMIT)
+    except ValueError:
+        return Response("since/limit inválidos\n", status=400, mimetype="text/plain")
+    limit = max(1, min(limit, CHANGES_MAX_LIMIT))
+
+    def generate():
+        for entry in iter_changes(since, limit):
+            yield json.dumps(entry, ensure_ascii=False) + "\n"
+
+    return Response(generate(), mimetype="application/x-ndjson")
+
+# -------------------------
+# Export CSV / PDF
+# -------------------------
+EXPORT_FETCH_SIZE = 1000
+# format -> (mimetype, file extension)
+EXPORT_FORMATS = {
+    "csv": ("text/csv", "csv"),
+    "csv.gz": ("application/gzip", "csv.gz"),
+    "jsonl": ("application/x-ndjson", "jsonl"),
+    "xlsx": ("application/vnd.openxmlformats-officedocument.spreadsheetml.sheet", "xlsx"),
+}
+
+def _iter_export_batches(office, scope):
+    """Yield lists of registro rows for an office straight off the cursor.
+
+    `scope` is the caller's office_scope_sql(), captured while the request
+    context still exists; it limits what "ALL" means for the user.
+    """
     conn = get_conn()
-    c = conn.cursor()
-    rows = []
-    if office.upper() == "ALL":
-        c.execute("SELECT * FROM registros")
-        rows = c.fetchall()
-    else:
-        key = normalize_office_key(office)
-        c.execute("SELECT * FROM registros WHERE escritorio_chave=?", (f"office_{key}",))
-        rows = c.fetchall()
-    conn.close()
+    try:
+        c = conn.cursor()
+        if office.upper() == "ALL":
+            scope_sql, scope_params = scope
+            c.execute(f"SELECT {REGISTRO_COLUMNS_SQL} FROM registros WHERE {scope_sql}", tuple(scope_params))
+        else:
+            key = normalize_office_key(office)
+            c.execute(f"SELECT {REGISTRO_COLUMNS_SQL} FROM registros WHERE escritorio_chave=?", (f"office_{key}",))
+        while True:
+            batch = c.fetchmany(EXPORT_FETCH_SIZE)
+            if not batch:
+                break
+            yield batch
+    finally:
+        conn.close()
+
+def _csv_chunks(batches):
+    buf = io.StringIO()
+    writer = csv.writer(buf, delimiter=";")
+    writer.writerow(REGISTRO_COLUMNS)
+    for batch in batches:
+        for r in batch:
+            writer.writerow([str(x) for x in r])
+        yield buf.getvalue().encode("utf-8")
+        buf.seek(0)
+        buf.truncate()
+    if buf.tell():
+        # no rows at all: just the header
+        yield buf.getvalue().encode("utf-8")
+
+def _gzip_chunks(chunks):
+    z = zlib.compressobj(6, zlib.DEFLATED, 31)  # wbits 31 = gzip container
+    for chunk in chunks:
+        out = z.compress(chunk)
+        if out:
+            yield out
+    yield z.flush()
+
+def _jsonl_chunks(batches):
+    for batch in batches:
+        yield "".join(json.dumps(dict(zip(REGISTRO_COLUMNS, r)), ensure_ascii=False) + "\n" for r in batch).encode("utf-8")
+
+# -- minimal streaming XLSX: inline strings, one sheet per XLSX_MAX_ROWS rows --
+XLSX_MAX_ROWS = 1048576
+_XML_HEAD = '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+_XLSX_NS = "http://schemas.openxmlformats.org/spreadsheetml/2006/main"
+_XLSX_REL_NS = "http://schemas.openxmlformats.org/officeDocument/2006/relationships"
+_XML_ILLEGAL = re.compile(r"[\x00-\x08\x0b\x0c\x0e-\x1f]")
+
+class _ChunkSink:
+    """Write-only, non-seekable file object drained by the response generator."""
+
+    def __init__(self):
+        self._parts = []
+        self._pos = 0
+
+    def write(self, data):
+        self._parts.append(bytes(data))
+        self._pos += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._pos
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b"".join(self._parts)
+        self._parts = []
+        return data
+
+def _xlsx_cell(value):
+    if value is None:
+        return "<c/>"
+    if isinstance(value, int):
+        return f"<c><v>{value}</v></c>"
+    text = xml_escape(_XML_ILLEGAL.sub("", str(value)))
+    return f'<c t="inlineStr"><is><t xml:space="preserve">{text}</t></is></c>'
+
+def _xlsx_row(values):
+    return "<row>" + "".join(_xlsx_cell(v) for v in values) + "</row>"
+
+def _xlsx_package_parts(sheet_count):
+    sheets = "".join(f'<sheet name="Registros{"" if i == 1 else " " + str(i)}" sheetId="{i}" r:id="rId{i}"/>'
+                     for i in range(1, sheet_count + 1))
+    sheet_rels = "".join(f'<Relationship Id="rId{i}" Type="{_XLSX_REL_NS}/worksheet" Target="worksheets/sheet{i}.xml"/>'
+                         for i in range(1, sheet_count + 1))
+    sheet_types = "".join(f'<Override PartName="/xl/worksheets/sheet{i}.xml" '
+                          'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+                          for i in range(1, sheet_count + 1))
+    return [
+        ("xl/workbook.xml", f'{_XML_HEAD}<workbook xmlns="{_XLSX_NS}" xmlns:r="{_XLSX_REL_NS}"><sheets>{sheets}</sheets></workbook>'),
+        ("xl/_rels/workbook.xml.rels", f'{_XML_HEAD}<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">{sheet_rels}</Relationships>'),
+        ("_rels/.rels", f'{_XML_HEAD}<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+                        f'<Relationship Id="rId1" Type="{_XLSX_REL_NS}/officeDocument" Target="xl/workbook.xml"/></Relationships>'),
+        ("[Content_Types].xml", f'{_XML_HEAD}<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+                                '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+                                '<Default Extension="xml" ContentType="application/xml"/>'
+                                '<Override PartName="/xl/workbook.xml" '
+                                'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+                                f'{sheet_types}</Types>'),
+    ]
+
+def _xlsx_chunks(batches):
+    """Stream an XLSX workbook; memory stays at one batch regardless of row count.
+
+    Sheets are written first and the workbook/relationship parts last, since
+    only then is the number of sheets known.
+    """
+    sink = _ChunkSink()
+    sheet_head = f'{_XML_HEAD}<worksheet xmlns="{_XLSX_NS}"><sheetData>'.encode("utf-8")
+    sheet_tail = b"</sheetData></worksheet>"
+    with zipfile.ZipFile(sink, "w", zipfile.ZIP_DEFLATED) as zf:
+        sheet_count = 0
+        sheet = None
+        rows_in_sheet = 0
+
+        def new_sheet():
+            nonlocal sheet, sheet_count, rows_in_sheet
+            if sheet is not None:
+                sheet.write(sheet_tail)
+                sheet.close()
+            sheet_count += 1
+            # size unknown up front: zip64 sizes so a sheet may pass 2 GiB
+            sheet = zf.open(f"xl/worksheets/sheet{sheet_count}.xml", "w", force_zip64=True)
+            sheet.write(sheet_head + _xlsx_row(REGISTRO_COLUMNS).encode("utf-8"))
+            rows_in_sheet = 1
+
+        new_sheet()
+        for batch in batches:
+            parts = []
+            for r in batch:
+                if rows_in_sheet >= XLSX_MAX_ROWS:
+                    sheet.write("".join(parts).encode("utf-8"))
+                    parts = []
+                    new_sheet()
+                parts.append(_xlsx_row(r))
+                rows_in_sheet += 1
+            sheet.write("".join(parts).encode("utf-8"))
+            data = sink.drain()
+            if data:
+                yield data
+        sheet.write(sheet_tail)
+        sheet.close()
+        for name, xml in _xlsx_package_parts(sheet_count):
+            zf.writestr(name, xml)
+    yield sink.drain()
+
+def _export_stream(fmt, office, scope):
+    batches = _iter_export_batches(office, scope)
+    if fmt == "csv":
+        return _csv_chunks(batches)
+    if fmt == "csv.gz":
+        return _gzip_chunks(_csv_chunks(batches))
+    if fmt == "jsonl":
+        return _jsonl_chunks(batches)
+    return _xlsx_chunks(batches)
+
+def _render_pdf(office, scope):
     buffer = io.BytesIO()
     p = canvas.Canvas(buffer, pagesize=letter)
     y = 750
     p.setFont("Helvetica-Bold", 12)
-    p.drawString(40, y, f"Registros - Escritório {office}")
+    # cached for every spelling of ?office=, so title it from the normalized office
+    title = "TODOS" if office.upper() == "ALL" else get_office_display(normalize_office_key(office))
+    p.drawString(40, y, f"Registros - Escritório {title}")
     y -= 24
     p.setFont("Helvetica", 10)
-    for r in rows:
-        line = " | ".join(str(x) for x in r[1:6])
-        p.drawString(20, y, line)
-        y -= 14
-        if y < 60:
-            p.showPage()
-            y = 750
+    for batch in _iter_export_batches(office, scope):
+        for r in batch:
+            line = " | ".join(str(x) for x in r[1:6])
+            p.drawString(20, y, line)
+            y -= 14
+            if y < 60:
+                p.showPage()
+                y = 750
     p.save()
-    buffer.seek(0)
-    return send_file(buffer, as_attachment=True, download_name=f"{office}_export.pdf", mimetype="application/pdf")
+    return buffer.getvalue()
+
+# -------------------------
+# Export cache
+# -------------------------
+def export_data_version(c, office):
+    """(seq, changed_at) of the newest change touching the office's registros.
+
+    Any insert/update/delete/migration in (or out of) the office bumps it, so
+    it is a cheap validator for everything exported from that office.
+    """
+    if office.upper() == "ALL":
+        c.execute("SELECT seq, changed_at FROM change_log ORDER BY seq DESC LIMIT 1")
+        row = c.fetchone()
+    else:
+        key = f"office_{normalize_office_key(office)}"
+        c.execute("""
+            SELECT seq, changed_at FROM (
+                SELECT * FROM (SELECT seq, changed_at FROM change_log WHERE escritorio_chave = ? ORDER BY seq DESC LIMIT 1)
+                UNION ALL
+                SELECT * FROM (SELECT seq, changed_at FROM change_log WHERE escritorio_origem = ? ORDER BY seq DESC LIMIT 1)
+            ) ORDER BY seq DESC LIMIT 1
+        """, (key, key))
+        row = c.fetchone()
+    return (row[0], row[1]) if row else (0, None)
+
+def export_cache_key(route, fmt, office, filters, version):
+    raw = json.dumps([route, fmt, office, filters or {}, version], sort_keys=True)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+def _export_cache_path(key):
+    return os.path.join(EXPORT_CACHE_DIR, key)
+
+def export_cache_open(key):
+    """Open a cached export for reading (None on miss) and mark it recently used.
+
+    The file is opened before returning, so a concurrent eviction in another
+    worker cannot pull it out from under the response.
+    """
+    path = _export_cache_path(key)
+    try:
+        f = open(path, "rb")
+    except FileNotFoundError:
+        return None
+    try:
+        os.utime(path)
+    except OSError:
+        pass
+    return f
+
+def _export_cache_evict():
+    try:
+        entries = [e for e in os.scandir(EXPORT_CACHE_DIR) if e.is_file() and not e.name.startswith(".")]
+    except FileNotFoundError:
+        return
+    stats = []
+    for e in entries:
+        try:
+            st = e.stat()
+        except FileNotFoundError:
+            continue
+        stats.append((st.st_mtime, st.st_size, e.path))
+    total = sum(size for _, size, _ in stats)
+    for _, size, path in sorted(stats):
+        if total <= EXPORT_CACHE_MAX_BYTES:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+
+def _export_cache_tmp():
+    os.makedirs(EXPORT_CACHE_DIR, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(prefix=".tmp-", dir=EXPORT_CACHE_DIR)
+    return os.fdopen(fd, "wb"), tmp_path
+
+def export_cache_store(key, data):
+    f, tmp_path = _export_cache_tmp()
+    try:
+        with f:
+            f.write(data)
+        os.replace(tmp_path, _export_cache_path(key))
+    except Exception:
+        os.remove(tmp_path)
+        raise
+    _export_cache_evict()
+
+def _export_cache_tee(key, chunks):
+    """Pass chunks through to the client while writing them to the cache.
+
+    The entry is only published (renamed into place) once the whole export was
+    produced; an aborted download leaves nothing behind.
+    """
+    f, tmp_path = _export_cache_tmp()
+    published = False
+    try:
+        with f:
+            for chunk in chunks:
+                f.write(chunk)
+                yield chunk
+        os.replace(tmp_path, _export_cache_path(key))
+        published = True
+        _export_cache_evict()
+    finally:
+        if not published and os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+def clear_export_cache():
+    if not os.path.isdir(EXPORT_CACHE_DIR):
+        return
+    for e in os.scandir(EXPORT_CACHE_DIR):
+        if e.is_file():
+            try:
+                os.remove(e.path)
+            except FileNotFoundError:
+                pass
+
+def _gunzip_stream(chunks):
+    z = zlib.decompressobj(31)
+    try:
+        for chunk in chunks:
+            out = z.decompress(chunk)
+            if out:
+                yield out
+        yield z.flush()
+    finally:
+        if hasattr(chunks, "close"):
+            chunks.close()
+
+def _file_chunks(f, size=64 * 1024):
+    with f:
+        while True:
+            block = f.read(size)
+            if not block:
+                return
+            yield block
+
+def _cached_export(route, fmt, office, mimetype, ext, produce, filters=None):
+    """Serve an export from the cache, or produce it and cache it on the way out.
+
+    `produce` returns either bytes or an iterator of byte chunks. Responses carry
+    the cache key as ETag and the data version time as Last-Modified. Text
+    formats are cached gzip'd and sent as-is (ETag "<key>-gzip", the same one
+    compress_response gives uncached responses) or inflated for clients that
+    don't accept gzip (ETag "<key>").
+    """
+    conn = get_conn()
+    version, version_at = export_data_version(conn.cursor(), office)
+    conn.close()
+    # ?office=central and ?office=CENTRAL are the same export
+    name = "ALL" if office.upper() == "ALL" else normalize_office_key(office)
+    key = export_cache_key(route, fmt, name, filters, version)
+    last_modified = datetime.fromisoformat(version_at) if version_at else None
+    download_name = f"{name}_export.{ext}"
+    use_cache = EXPORT_CACHE_MAX_BYTES > 0
+    compressed = use_cache and mimetype in COMPRESSIBLE_MIMETYPES
+    encoding = _accepted_encoding(allow_br=False) if compressed else None
+
+    if use_cache:
+        f = export_cache_open(key)
+        if f is not None and (not compressed or encoding):
+            rv = send_file(f, mimetype=mimetype, as_attachment=True, download_name=download_name,
+                           etag=f"{key}-{encoding}" if encoding else key,
+                           last_modified=last_modified, conditional=True)
+            if encoding:
+                rv.headers["Content-Encoding"] = encoding
+                rv.vary.add("Accept-Encoding")
+            rv.headers["Cache-Control"] = "private, no-cache"
+            return rv
+        if f is not None:
+            rv = Response(_gunzip_stream(_file_chunks(f)), mimetype=mimetype)
+            rv.call_on_close(f.close)
+        else:
+            body = produce()
+            if compressed:
+                stored = _export_cache_tee(key, _gzip_stream([body] if isinstance(body, bytes) else body))
+                rv = Response(stored if encoding else _gunzip_stream(stored), mimetype=mimetype)
+            elif isinstance(body, bytes):
+                export_cache_store(key, body)
+                rv = Response(body, mimetype=mimetype)
+            else:
+                rv = Response(_export_cache_tee(key, body), mimetype=mimetype)
+    else:
+        rv = Response(produce(), mimetype=mimetype)
+    rv.headers["Content-Disposition"] = f'attachment; filename="{download_name}"'
+    rv.headers["Cache-Control"] = "private, no-cache"
+    if encoding:
+        rv.headers["Content-Encoding"] = encoding
+    if compressed:
+        rv.vary.add("Accept-Encoding")
+    rv.set_etag(f"{key}-{encoding}" if encoding else key)
+    if last_modified:
+        rv.last_modified = last_modified
+    # a 304 never starts the body, so streamed exports are left unproduced
+    rv.make_conditional(request)
+    return rv
+
+def _export_scope(office):
+    """(scope, cache filters) for exporting `office`; scope is None when it is off-limits.
+
+    Restricted users' ALL exports only contain their offices, so their office
+    set becomes part of the cache key.
+    """
+    if office.upper() == "ALL":
+        acl = allowed_offices()
+        return office_scope_sql(), ({"offices": acl} if acl is not None else None)
+    if not can_access_office(office):
+        return None, None
+    return office_scope_sql(), None
+
+@app.route("/export/csv")
+@login_required
+@limit_concurrency("exports")
+def export_csv():
+    """Stream the office's registros; ?format=csv (default), csv.gz, jsonl or xlsx."""
+    office = request.args.get("office", "CENTRAL")
+    fmt = request.args.get("format", "csv").lower()
+    if fmt not in EXPORT_FORMATS:
+        return Response("formato inválido\n", status=400, mimetype="text/plain")
+    mimetype, ext = EXPORT_FORMATS[fmt]
+    scope, filters = _export_scope(office)
+    if scope is None:
+        flash("Sem acesso a este escritório.", "error")
+        return redirect(url_for("table"))
+    return _cached_export("export_csv", fmt, office, mimetype, ext, lambda: _export_stream(fmt, office, scope), filters)
+
+@app.route("/export/pdf")
+@login_required
+@limit_concurrency("exports")
+def export_pdf():
+    office = request.args.get("office", "CENTRAL")
+    scope, filters = _export_scope(office)
+    if scope is None:
+        flash("Sem acesso a este escritório.", "error")
+        return redirect(url_for("table"))
+    return _cached_export("export_pdf", "pdf", office, "application/pdf", "pdf", lambda: _render_pdf(office, scope), filters)
+
+# -------------------------
+# Backup / restore
+# -------------------------
+
+class _BackupRestarted(Exception):
+    pass
+
+def _integrity_ok(path):
+    conn = sqlite3.connect(path)
+    try:
+        row = conn.execute("PRAGMA integrity_check").fetchone()
+    finally:
+        conn.close()
+    return bool(row) and row[0] == "ok"
+
+def _copy_database(dest_path):
+    pause = BACKUP_SLEEP_MS / 1000.0
+    state = {"remaining": None, "restarts": 0}
+
+    def progress(status, remaining, total):
+        # a write from another connection makes SQLite start the copy over
+        if state["remaining"] is not None and remaining > state["remaining"]:
+            state["restarts"] += 1
+            if state["restarts"] > BACKUP_MAX_RESTARTS:
+                raise _BackupRestarted()
+        state["remaining"] = remaining
+        if remaining and pause > 0:
+            time.sleep(pause)
+
+    src = get_conn()
+    try:
+        dst = sqlite3.connect(dest_path)
+        try:
+            try:
+                src.backup(dst, pages=BACKUP_PAGES, progress=progress)
+            except _BackupRestarted:
+                # too busy to finish in steps: copy in one go. Under WAL this is a
+                # single read transaction, so writers still are not blocked.
+                src.backup(dst, pages=-1)
+        finally:
+            dst.close()
+    finally:
+        src.close()
+
+def list_backups(dest_dir=None):
+    dest_dir = dest_dir or BACKUP_DIR
+    if not os.path.isdir(dest_dir):
+        return []
+    out = []
+    for name in sorted(os.listdir(dest_dir), reverse=True):
+        if name.startswith("database-") and name.endswith(".db.gz"):
+            st = os.stat(os.path.join(dest_dir, name))
+            out.append({"name": name, "size": st.st_size,
+                        "created_at": datetime.utcfromtimestamp(st.st_mtime).isoformat(timespec="seconds")})
+    return out
+
+def _rotate_backups(dest_dir, keep):
+    for b in list_backups(dest_dir)[keep:]:
+        os.remove(os.path.join(dest_dir, b["name"]))
+
+class BackupBusy(RuntimeError):
+    pass
+
+def backup_database(dest_dir=None, keep=None):
+    """Write a gzip-compressed, timestamped snapshot of the live database.
+
+    The copy goes through SQLite's online backup API BACKUP_PAGES pages at a
+    time with a short sleep between steps, so writers are never held up for
+    long. The raw copy is integrity-checked before compression, the .gz is
+    renamed into place only when complete, and only the newest `keep`
+    snapshots are kept. Returns the snapshot path. Raises BackupBusy if
+    another process is already taking a snapshot.
+    """
+    release = _acquire_slot("backup")
+    if release is None:
+        raise BackupBusy("já existe um backup em andamento")
+    try:
+        return _write_backup(dest_dir, keep)
+    finally:
+        release()
+
+def _write_backup(dest_dir, keep):
+    dest_dir = dest_dir or BACKUP_DIR
+    keep = BACKUP_KEEP if keep is None else keep
+    os.makedirs(dest_dir, exist_ok=True)
+    stamp = datetime.utcnow().strftime("%Y%m%d-%H%M%S-%f")
+    final_path = os.path.join(dest_dir, f"database-{stamp}.db.gz")
+    fd, raw_path = tempfile.mkstemp(prefix=".backup-", suffix=".db", dir=dest_dir)
+    os.close(fd)
+    fd, tmp_path = tempfile.mkstemp(prefix=".backup-", suffix=".gz", dir=dest_dir)
+    os.close(fd)
+    try:
+        _copy_database(raw_path)
+        if not _integrity_ok(raw_path):
+            raise RuntimeError("integrity_check falhou na cópia do banco")
+        with open(raw_path, "rb") as fin, gzip.open(tmp_path, "wb", compresslevel=6) as fout:
+            shutil.copyfileobj(fin, fout, 1024 * 1024)
+        os.replace(tmp_path, final_path)
+    finally:
+        for p in (raw_path, tmp_path):
+            if os.path.exists(p):
+                os.remove(p)
+    if keep > 0:
+        _rotate_backups(dest_dir, keep)
+    return final_path
+
+def _unpack_backup(snapshot_path):
+    fd, raw_path = tempfile.mkstemp(prefix=".restore-", suffix=".db", dir=os.path.dirname(DB_PATH))
+    os.close(fd)
+    with gzip.open(snapshot_path, "rb") as fin, open(raw_path, "wb") as fout:
+        shutil.copyfileobj(fin, fout, 1024 * 1024)
+    return raw_path
+
+def verify_backup(snapshot_path):
+    raw_path = _unpack_backup(snapshot_path)
+    try:
+        return _integrity_ok(raw_path)
+    finally:
+        os.remove(raw_path)
+
+def restore_backup(snapshot_path):
+    """Replace the live database contents with a snapshot.
+
+    The snapshot is unpacked and integrity-checked first; nothing is touched
+    if the check fails.
+    """
+    raw_path = _unpack_backup(snapshot_path)
+    try:
+        if not _integrity_ok(raw_path):
+            raise RuntimeError(f"integrity_check falhou em {snapshot_path}")
+        src = sqlite3.connect(raw_path)
+        dst = get_conn()
+        try:
+            src.backup(dst)
+        finally:
+            dst.close()
+            src.close()
+        # change_log seqs start over from the snapshot, so cached versions mean nothing now
+        clear_export_cache()
+    finally:
+        os.remove(raw_path)
+
+def _backup_in_background(release):
+    try:
+        path = _write_backup(None, None)
+        app.logger.info("backup criado: %s", path)
+    except Exception:
+        app.logger.exception("backup falhou")
+    finally:
+        release()
+
+def backup_running():
+    release = _acquire_slot("backup")
+    if release is None:
+        return True
+    release()
+    return False
+
+@app.route("/admin/backup", methods=["GET", "POST"])
+@login_required
+@require_roles("ADMIN")
+def admin_backup():
+    if request.method == "POST":
+        # the slot is held across workers and the CLI until the thread finishes
+        release = _acquire_slot("backup")
+        if release is not None:
+            threading.Thread(target=_backup_in_background, args=(release,), name="backup", daemon=True).start()
+            flash("Backup iniciado em segundo plano.", "success")
+        else:
+            flash("Já existe um backup em andamento.", "error")
+        return redirect(url_for("admin_backup"))
+    return render_template("admin_backup.html", backups=list_backups(), running=backup_running())
+
+@app.cli.command("backup")
+@click.option("--dest", default=None, help="Diretório de destino (padrão: BACKUP_DIR).")
+@click.option("--keep", default=None, type=int, help="Quantos snapshots manter.")
+def backup_command(dest, keep):
+    """Online, compressed snapshot of the database."""
+    try:
+        click.echo(backup_database(dest, keep))
+    except BackupBusy as e:
+        raise click.ClickException(str(e))
+
+@app.cli.command("verify-backup")
+@click.argument("snapshot")
+def verify_backup_command(snapshot):
+    """Run integrity_check on a snapshot."""
+    if not verify_backup(snapshot):
+        raise click.ClickException("integrity_check falhou")
+    click.echo("ok")
+
+@app.cli.command("restore")
+@click.argument("snapshot")
+def restore_command(snapshot):
+    """Restore the database from a verified snapshot."""
+    restore_backup(snapshot)
+    click.echo("restaurado de " + snapshot)
+
+@app.cli.command("bench-login")
+@click.option("--method", "methods", multiple=True, help="Método werkzeug a medir (repetível; padrão: PASSWORD_HASH_METHOD).")
+@click.option("--rounds", default=20, show_default=True, help="Verificações por método.")
+def bench_login_command(methods, rounds):
+    """Time password verification per hashing method, alone and on the login pool."""
+    for method in methods or (PASSWORD_HASH_METHOD,):
+        pw_hash = hash_password("bench-password", method)
+        start = time.perf_counter()
+        for _ in range(rounds):
+            check_password_hash(pw_hash, "bench-password")
+        single = (time.perf_counter() - start) / rounds
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=max(1, LOGIN_HASH_WORKERS)) as pool:
+            list(pool.map(lambda _: check_password_hash(pw_hash, "bench-password"), range(rounds)))
+        pooled = rounds / (time.perf_counter() - start)
+        click.echo(f"{hash_prefix(method)}: {single * 1000:.1f} ms/login, "
+                   f"{pooled:.1f} logins/s with {LOGIN_HASH_WORKERS} workers")
 
 # -------------------------
 # Run
@@ -55,3 +55,190 @@ function validarSelecao() {
     }
     return true;
 }
+
+
+// ------------------------------
+// Autocomplete (nome / CPF) no filtro da tabela
+// ------------------------------
+function debounce(fn, ms) {
+    let timer = null;
+    return (...args) => {
+        clearTimeout(timer);
+        timer = setTimeout(() => fn(...args), ms);
+    };
+}
+
+function initTypeahead(input) {
+    const list = document.createElement("ul");
+    list.className = "typeahead-list";
+    list.hidden = true;
+    input.parentNode.appendChild(list);
+
+    let controller = null;
+    let items = [];
+    let active = -1;
+
+    function close() {
+        list.hidden = true;
+        list.innerHTML = "";
+        items = [];
+        active = -1;
+    }
+
+    function choose(item) {
+        // mostra só o registro escolhido na tabela
+        const form = input.form;
+        const filtro = form.querySelector("select[name='filtro']");
+        if (filtro) filtro.value = "id";
+        input.value = item.id;
+        close();
+        form.submit();
+    }
+
+    function highlight(index) {
+        const lis = list.querySelectorAll("li");
+        lis.forEach((li, i) => li.classList.toggle("active", i === index));
+        active = index;
+    }
+
+    function render(results) {
+        list.innerHTML = "";
+        items = results;
+        active = -1;
+        results.forEach(item => {
+            const li = document.createElement("li");
+            li.textContent = item.nome + " — " + (item.cpf || "") + " (" + (item.escritorio || "") + ")";
+            li.addEventListener("mousedown", ev => {
+                ev.preventDefault();
+                choose(item);
+            });
+            list.appendChild(li);
+        });
+        list.hidden = results.length === 0;
+    }
+
+    const search = debounce(() => {
+        const q = input.value.trim();
+        // cancela a requisição anterior ainda em andamento
+        if (controller) controller.abort();
+        if (q.length < 2) {
+            close();
+            return;
+        }
+        controller = new AbortController();
+        const url = input.dataset.typeahead + "&q=" + encodeURIComponent(q);
+        fetch(url, { signal: controller.signal, headers: { "Accept": "application/json" } })
+            .then(resp => resp.ok ? resp.json() : { results: [] })
+            .then(data => render(data.results || []))
+            .catch(err => {
+                if (err.name !== "AbortError") close();
+            });
+    }, 150);
+
+    input.addEventListener("input", search);
+    input.addEventListener("blur", close);
+    input.addEventListener("keydown", ev => {
+        if (list.hidden) return;
+        if (ev.key === "ArrowDown") {
+            ev.preventDefault();
+            highlight(Math.min(active + 1, items.length - 1));
+        } else if (ev.key === "ArrowUp") {
+            ev.preventDefault();
+            highlight(Math.max(active - 1, 0));
+        } else if (ev.key === "Enter" && active >= 0) {
+            ev.preventDefault();
+            choose(items[active]);
+        } else if (ev.key === "Escape") {
+            close();
+        }
+    });
+}
+
+document.addEventListener("DOMContentLoaded", () => {
+    document.querySelectorAll("input[data-typeahead]").forEach(initTypeahead);
+});
+
+
+// ------------------------------
+// Tabela: troca parcial de linhas/paginação (?partial=1) + prefetch
+// ------------------------------
+function initPartialTable() {
+    if (!document.getElementById("table-rows") || !window.fetch || !window.history.pushState) return;
+
+    const prefetched = new Map();
+
+    function partialUrl(url) {
+        const u = new URL(url, window.location.href);
+        u.searchParams.set("partial", "1");
+        return u.toString();
+    }
+
+    function fetchFragment(url) {
+        return fetch(partialUrl(url), { headers: { "Accept": "text/html" } })
+            .then(resp => {
+                if (!resp.ok || resp.redirected) throw new Error("fragment " + resp.status);
+                return resp.text();
+            });
+    }
+
+    function swap(html) {
+        const tpl = document.createElement("template");
+        tpl.innerHTML = html;
+        const head = tpl.content.querySelector("#table-head");
+        const rows = tpl.content.querySelector("#table-rows");
+        const pagination = tpl.content.querySelector("#table-pagination");
+        if (!head || !rows || !pagination) throw new Error("fragment incompleto");
+        // cabeçalho junto: os links de ordenação carregam os filtros atuais
+        document.getElementById("table-head").replaceWith(head);
+        document.getElementById("table-rows").replaceWith(rows);
+        document.getElementById("table-pagination").replaceWith(pagination);
+    }
+
+    function prefetchNext() {
+        const next = document.querySelector("#table-pagination a[rel='next']");
+        if (!next || prefetched.has(next.href)) return;
+        const idle = window.requestIdleCallback || (cb => setTimeout(cb, 200));
+        idle(() => {
+            const pending = fetchFragment(next.href);
+            pending.catch(() => prefetched.delete(next.href));
+            prefetched.set(next.href, pending);
+        });
+    }
+
+    function load(url, push) {
+        const pending = prefetched.get(url) || fetchFragment(url);
+        prefetched.clear();
+        pending
+            .then(html => {
+                swap(html);
+                if (push) window.history.pushState({ partial: true }, "", url);
+                prefetchNext();
+            })
+            // sem fragmento (sessão expirada, erro): navegação normal
+            .catch(() => { window.location.href = url; });
+    }
+
+    document.addEventListener("click", ev => {
+        const link = ev.target.closest("#table-pagination a");
+        if (!link || ev.ctrlKey || ev.metaKey || ev.shiftKey || ev.button !== 0) return;
+        ev.preventDefault();
+        load(link.href, true);
+    });
+
+    document.addEventListener("submit", ev => {
+        const form = ev.target;
+        if (!form.classList || !form.classList.contains("table-nav")) return;
+        ev.preventDefault();
+        const url = new URL(form.action, window.location.href);
+        new FormData(form).forEach((value, key) => {
+            if (value !== "") url.searchParams.append(key, value);
+        });
+        load(url.toString(), true);
+    });
+
+    window.addEventListener("popstate", () => load(window.location.href, false));
+
+    prefetchNext();
+}
+
+document.addEventListener("DOMContentLoaded", initPartialTable);
@@ -0,0 +1,13 @@
+import os
+import sys
+import tempfile
+
+# scratch database / slot / cache dirs, set before app is imported
+_tmp = tempfile.mkdtemp()
+os.environ.update({
+    "DB_PATH": os.path.join(_tmp, "database.db"),
+    "LIMIT_DIR": os.path.join(_tmp, "limits"),
+    "EXPORT_CACHE_DIR": os.path.join(_tmp, "export_cache"),
+    "LIMIT_EXPORTS": "2",
+})
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,16 @@
+import gzip
+import json
+
+import app as app_module
+
+
+def test_changes_feed_gzip():
+    client = app_module.app.test_client()
+    client.post("/login", data={"username": "admin", "password": "admin"})
+    client.post("/submit", data={"nome": "Ciclano", "cpf": "2", "escritorio": "CENTRAL"})
+    rv = client.get("/changes?since=0", headers={"Accept-Encoding": "gzip, deflate"})
+    assert rv.status_code == 200
+    assert rv.headers["Content-Encoding"] == "gzip"
+    lines = gzip.decompress(rv.get_data()).decode("utf-8").splitlines()
+    rv.close()
+    assert any(json.loads(line)["row"]["nome"] == "Ciclano" for line in lines)
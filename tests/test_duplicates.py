@@ -0,0 +1,24 @@
+import app as app_module
+
+
+def _warned(client, **form):
+    data = {"escritorio": "CENTRAL", "cpf": "", **form}
+    html = client.post("/submit", data=data, follow_redirects=True).get_data(as_text=True)
+    return "flash-warning" in html
+
+
+def test_duplicate_warnings():
+    client = app_module.app.test_client()
+    client.post("/login", data={"username": "admin", "password": "admin"})
+    assert not _warned(client, nome="Maria Souza", cpf="111.111.111-11")
+    # same name, different CPF: different people
+    assert not _warned(client, nome="MARIA SOUZA", cpf="222.222.222-22")
+    # same CPF, other name
+    assert _warned(client, nome="Outra", cpf="11111111111")
+    # no CPF on one side: the name is all there is to go by
+    assert _warned(client, nome="maria  souza")
+    assert _warned(client, nome="Joao Lima", cpf="") is False
+    assert _warned(client, nome="João Lima", cpf="333.333.333-33")
+    # blank rows are nobody's duplicate
+    assert not _warned(client, nome="")
+    assert not _warned(client, nome="")
@@ -0,0 +1,24 @@
+import os
+
+import app as app_module
+
+
+def test_shared_limit_dir_is_refused(monkeypatch, tmp_path):
+    shared = tmp_path / "shared"
+    shared.mkdir()
+    os.chmod(shared, 0o777)
+    monkeypatch.setattr(app_module, "LIMIT_DIR", str(shared))
+    monkeypatch.setattr(app_module, "_limit_dir_checked", None)
+    monkeypatch.setattr(app_module, "_local_slots", {})
+    release = app_module._acquire_slot("exports")
+    assert release is not None
+    release()
+    assert not app_module._limit_dir_usable()
+    assert os.listdir(shared) == []
+
+
+def test_private_limit_dir(monkeypatch, tmp_path):
+    monkeypatch.setattr(app_module, "LIMIT_DIR", str(tmp_path / "limits"))
+    monkeypatch.setattr(app_module, "_limit_dir_checked", None)
+    assert app_module._limit_dir_usable()
+    assert os.stat(tmp_path / "limits").st_mode & 0o777 == 0o700
@@ -0,0 +1,14 @@
+import app as app_module
+
+
+def test_export_slots_released_after_repeat_downloads():
+    client = app_module.app.test_client()
+    client.post("/login", data={"username": "admin", "password": "admin"})
+    client.post("/submit", data={"nome": "Fulano", "cpf": "1", "escritorio": "CENTRAL"})
+    # first download fills the cache, the rest are served from it via send_file
+    for fmt in ("csv", "jsonl"):
+        for _ in range(app_module.CONCURRENCY_LIMITS["exports"] + 3):
+            rv = client.get(f"/export/csv?office=CENTRAL&format={fmt}")
+            assert rv.status_code == 200
+            assert b"Fulano" in rv.get_data()
+            rv.close()
@@ -0,0 +1,21 @@
+import pytest
+
+import app as app_module
+
+
+@pytest.mark.parametrize("q", ["ab\U0010ffff", "\U0010ffff\U0010ffff", "ab\ud7ff", "jos"])
+def test_search_prefix_edges(q):
+    client = app_module.app.test_client()
+    client.post("/login", data={"username": "admin", "password": "admin"})
+    client.post("/submit", data={"nome": "José", "cpf": "", "escritorio": "CENTRAL"})
+    rv = client.get("/api/search", query_string={"q": q, "office": "CENTRAL"})
+    assert rv.status_code == 200
+    if q == "jos":
+        assert rv.get_json()["results"]
+
+
+def test_prefix_range():
+    assert app_module._prefix_range("ab") == ("ab", "ac")
+    assert app_module._prefix_range("a\U0010ffff") == ("a\U0010ffff", "b")
+    assert app_module._prefix_range("\U0010ffff") == ("\U0010ffff", None)
+    assert app_module._prefix_range("a\ud7ff") == ("a\ud7ff", "a\ue000")
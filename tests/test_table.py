@@ -0,0 +1,30 @@
+import base64
+import json
+
+import pytest
+
+import app as app_module
+
+
+def _token(value):
+    return base64.urlsafe_b64encode(json.dumps(value).encode()).decode()
+
+
+@pytest.mark.parametrize("cursor", [
+    [[1], 2], [{"a": 1}, 2], [None, 1e999], [None, 99999999999999999999999],
+    [99999999999999999999999, 1], [None, "1"], [None, 1.5], "x",
+])
+def test_crafted_after_token_falls_back(cursor):
+    client = app_module.app.test_client()
+    client.post("/login", data={"username": "admin", "password": "admin"})
+    for sort in ("id", "nome"):
+        rv = client.get(f"/table?office=CENTRAL&sort={sort}&after={_token(cursor)}")
+        assert rv.status_code == 200
+
+
+def test_fragment_sort_links_keep_filters():
+    client = app_module.app.test_client()
+    client.post("/login", data={"username": "admin", "password": "admin"})
+    html = client.get("/table?office=CENTRAL&filtro=nome&valor=ana&per_page=20&partial=1").get_data(as_text=True)
+    assert 'id="table-head"' in html
+    assert "sort=nome" in html and "valor=ana" in html and "per_page=20" in html
@@ -0,0 +1,24 @@
+import sqlite3
+
+import pytest
+
+import app as app_module
+
+
+def _insert(c, nome):
+    c.execute("INSERT INTO offices (office_key, display_name) VALUES (?, ?)", (nome, nome))
+    return c.lastrowid
+
+
+def test_writer_setup_failure_reaches_callers(monkeypatch):
+    wq = app_module.WriteQueue()
+
+    def failing_get_conn():
+        raise sqlite3.OperationalError("unable to open database file")
+
+    monkeypatch.setattr(app_module, "get_conn", failing_get_conn)
+    with pytest.raises(sqlite3.OperationalError):
+        wq.submit(_insert, "WQ_FAIL")
+    monkeypatch.undo()
+    # the next submit gets a fresh writer
+    assert wq.submit(_insert, "WQ_OK")